@@ -1,8 +1,9 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash, g, Response
 import os
+import time
 import uuid
-import pandas as pd
+from metrics import Metrics, SlowRequestProfiler
 from recommendation_engine import ProductRecommendationEngine
 from werkzeug.utils import secure_filename
 
@@ -16,61 +17,15 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # CSV file path
 csv_path = 'lcbo_wines_updated.csv'
-absolute_path = os.path.abspath(csv_path)
-print(f"Looking for CSV at: {absolute_path}")
-print(f"File exists: {os.path.exists(absolute_path)}")
-
-# Try to read the CSV file directly to verify it's accessible
-try:
-    print("Reading CSV file directly:")
-    df = pd.read_csv(csv_path)
-    print(f"Successfully loaded {len(df)} rows with pandas")
-    print(f"Columns: {df.columns.tolist()}")
-    if len(df) > 0:
-        print(f"First row sample: {df.iloc[0][['title', 'category', 'price']].to_dict()}")
-except Exception as e:
-    print(f"Error reading CSV directly: {str(e)}")
-
-# Initialize recommendation engine
-engine = ProductRecommendationEngine()
-
-# Reset ChromaDB collections to start fresh
-print("Resetting ChromaDB collections...")
-try:
-    engine.client.delete_collection(name="products")
-    print("Deleted products collection")
-except Exception as e:
-    print(f"No products collection to delete or error: {str(e)}")
-
-try:
-    engine.client.delete_collection(name="user_preferences")
-    print("Deleted user_preferences collection")
-except Exception as e:
-    print(f"No user_preferences collection to delete or error: {str(e)}")
-
-# Recreate collections
-engine.product_collection = engine.client.create_collection(
-    name="products",
-    metadata={"hnsw:space": "cosine"}
-)
-engine.user_collection = engine.client.create_collection(
-    name="user_preferences",
-    metadata={"hnsw:space": "cosine"}
-)
-
-# Clear existing products list
-engine.products = []
+print(f"Looking for CSV at: {os.path.abspath(csv_path)}")
+print(f"File exists: {os.path.exists(csv_path)}")
 
-# Load products from CSV
-if os.path.exists(csv_path):
-    print("Found CSV file, attempting to load...")
-    count = engine.load_products_from_csv(csv_path)
-    print(f"Loaded {count} wine products from CSV")
-else:
-    print(f"CSV file not found at: {os.path.abspath(csv_path)}")
 
-# Add sample products if no products were loaded
-if len(engine.products) == 0:
+def add_sample_products(engine):
+    """Add sample products if no products were loaded"""
+    if len(engine.products) > 0:
+        return
+    
     print("No products loaded, adding sample products...")
     sample_products = [
         {
@@ -108,33 +63,99 @@ if len(engine.products) == 0:
     print(f"Added {len(sample_products)} sample wine products")
 
 
+if not os.path.exists(csv_path):
+    print(f"CSV file not found at: {os.path.abspath(csv_path)}")
+    csv_path = None
+
+# FEEDBACK_MODE=async moves feedback persistence and preference updates off
+# the request thread
+feedback_mode = os.environ.get('FEEDBACK_MODE', 'sync')
+
+# ENCODER_BACKEND=onnx or onnx-int8 runs the encoder with onnxruntime instead
+# of PyTorch
+encoder_backend = os.environ.get('ENCODER_BACKEND', 'torch')
+
+# Request and per-stage engine timings, served at /metrics (METRICS=0 turns
+# them off). PROFILE_SAMPLE_RATE=0.01 runs cProfile on 1% of requests and
+# keeps those slower than PROFILE_SLOW_MS in PROFILE_DIR
+metrics = Metrics(enabled=os.environ.get('METRICS', '1') != '0')
+profiler = SlowRequestProfiler(
+    sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', '0')),
+    slow_seconds=float(os.environ.get('PROFILE_SLOW_MS', '500')) / 1000,
+    out_dir=os.environ.get('PROFILE_DIR', 'data/profiles')
+)
+metrics.add_collector(lambda: [('slow_request_profiles_total', 'counter', profiler.captured, None)])
+
+# Products already shown to each user are remembered on the server and logged
+# here so they survive a restart (VIEWED_HISTORY_PATH= keeps them in memory only)
+viewed_history_path = os.environ.get('VIEWED_HISTORY_PATH', 'data/viewed_history.jsonl') or None
+
+if os.environ.get('ENGINE_MODE') == 'shared':
+    # Under Gunicorn (see gunicorn.conf.py) the engine is warmed up once in the
+    # master, before forking, and its model and catalogue matrix are shared
+    # copy-on-write by the workers. EMBEDDING_PRECISION=float16 or int8 scans
+    # a compressed copy of the matrix instead
+    engine = ProductRecommendationEngine(lazy=True, shared=True, vector_backend="numpy",
+                                         embedding_precision=os.environ.get('EMBEDDING_PRECISION', 'float32'),
+                                         encoder_backend=encoder_backend, feedback_mode=feedback_mode,
+                                         viewed_history_path=viewed_history_path, metrics=metrics)
+    engine.warm_up(csv_path, on_ready=add_sample_products)
+    engine.share_catalogue()
+else:
+    # Initialize recommendation engine without blocking on the model or vector
+    # index; until warm-up finishes, '/' serves random picks from the catalogue
+    engine = ProductRecommendationEngine(lazy=True, encoder_backend=encoder_backend,
+                                         feedback_mode=feedback_mode, viewed_history_path=viewed_history_path,
+                                         metrics=metrics)
+    
+    # Sync the persisted catalogue with the CSV in the background; unchanged
+    # rows and user preference vectors are kept as they are
+    engine.start_background_warmup(csv_path, on_ready=add_sample_products)
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg', 'gif'}
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profile = profiler.start()
+
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('http_request_seconds', elapsed, endpoint=endpoint)
+    metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+    profiler.finish(g.profile, elapsed, endpoint)
+    return response
+
+
+@app.before_request
+def move_viewed_ids_out_of_cookie():
+    # Sessions started before the server-side history kept the list in the
+    # cookie; fold it in once and drop it
+    legacy_ids = session.pop('viewed_product_ids', None)
+    if legacy_ids and 'user_id' in session:
+        engine.viewed_history.add(session['user_id'], legacy_ids)
+
+
 @app.route('/')
 def index():
     # Get or create a user ID
     if 'user_id' not in session:
         session['user_id'] = str(uuid.uuid4())
     
-    # Get viewed product IDs from session
-    viewed_product_ids = session.get('viewed_product_ids', [])
-    
-    # Get recommendations
+    # Get recommendations, skipping and then remembering what the user has
+    # already been shown
     products = engine.get_recommendations(
         user_id=session['user_id'],
         n_results=3,
-        excluded_ids=viewed_product_ids
+        record_views=True
     )
     
-    # Add product IDs to viewed list
-    for product in products:
-        if product['id'] not in viewed_product_ids:
-            viewed_product_ids.append(product['id'])
-    
-    session['viewed_product_ids'] = viewed_product_ids
-    
     # Get user feedback for display
     user_feedback = {}
     if session['user_id'] in engine.feedback.get('users', {}):
@@ -159,20 +180,12 @@ def product_feedback():
     engine.add_feedback(session['user_id'], product_id, feedback_type)
     
     # Get next batch of recommendations
-    viewed_product_ids = session.get('viewed_product_ids', [])
     new_products = engine.get_recommendations(
         user_id=session['user_id'],
         n_results=3,
-        excluded_ids=viewed_product_ids
+        record_views=True
     )
     
-    # Update viewed products
-    for product in new_products:
-        if product['id'] not in viewed_product_ids:
-            viewed_product_ids.append(product['id'])
-    
-    session['viewed_product_ids'] = viewed_product_ids
-    
     return jsonify({
         'success': True,
         'message': 'Feedback recorded successfully',
@@ -180,12 +193,80 @@ def product_feedback():
     })
 
 
+# Most results a JSON route returns for one request
+MAX_RESULTS = 100
+
+
+def requested_count(default):
+    """The n query argument, or None unless it is between 1 and MAX_RESULTS"""
+    n = request.args.get('n', default, type=int)
+    return n if 1 <= n <= MAX_RESULTS else None
+
+
+@app.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'auto')
+    
+    if not query or mode not in ['auto', 'lexical', 'vector', 'hybrid']:
+        return jsonify({'error': 'A query (q) and a valid mode are required'}), 400
+    n_results = requested_count(10)
+    if n_results is None:
+        return jsonify({'error': f'n must be between 1 and {MAX_RESULTS}'}), 400
+    
+    products = engine.search_products(
+        query,
+        n_results=n_results,
+        mode=mode,
+        user_id=session.get('user_id')
+    )
+    
+    return jsonify({'query': query, 'products': products})
+
+
+@app.route('/similar/<product_id>')
+def similar_products(product_id):
+    n_results = requested_count(5)
+    if n_results is None:
+        return jsonify({'error': f'n must be between 1 and {MAX_RESULTS}'}), 400
+    products = engine.get_similar_products(product_id, n_results=n_results)
+    if products is None:
+        return jsonify({'error': 'Product not found'}), 404
+    
+    return jsonify({'product_id': product_id, 'products': products})
+
+
+@app.route('/ready')
+def ready():
+    status = {
+        'ready': engine.is_ready(),
+        'products': len(engine.products),
+        'error': engine.warmup_error,
+        'feedback_queue': engine.feedback_queue_stats(),
+        'recommendation_cache': engine.recommendation_cache.stats(),
+        'encoder': engine.encoder.stats()
+    }
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics are disabled (METRICS=0)'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/reset')
 def reset_recommendations():
-    session['viewed_product_ids'] = []
+    if 'user_id' in session:
+        engine.clear_viewed_history(session['user_id'])
     return redirect(url_for('index'))
 
 
+# Shared-mode workers each hold a copy of the catalogue, so edits are refused
+CATALOGUE_READ_ONLY = 'The catalogue is read-only while running with ENGINE_MODE=shared'
+
+
 @app.route('/admin')
 def admin():
     products = engine.products
@@ -195,6 +276,9 @@ def admin():
 @app.route('/admin/add', methods=['GET', 'POST'])
 def add_product():
     if request.method == 'POST':
+        if not engine.catalogue_editable:
+            return jsonify({'error': CATALOGUE_READ_ONLY}), 409
+        
         name = request.form.get('name')
         description = request.form.get('description')
         price = request.form.get('price')
@@ -237,6 +321,8 @@ def add_product():
 
 @app.route('/admin/delete/<product_id>', methods=['POST'])
 def delete_product(product_id):
+    if not engine.catalogue_editable:
+        return jsonify({'error': CATALOGUE_READ_ONLY}), 409
     engine.delete_product(product_id)
     flash('Product deleted successfully', 'success')
     return redirect(url_for('admin'))
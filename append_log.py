@@ -0,0 +1,221 @@
+# append_log.py
+import os
+import json
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows; a single process needs no lock
+    fcntl = None
+
+
+class AppendLog:
+    """A JSON-lines file that several processes append to and tail.
+
+    Each record goes out as a single O_APPEND write, so lines from different
+    processes never interleave. Appends hold a shared lock on a side file,
+    and whoever rewrites the log holds it exclusively (see locked()), so no
+    line is appended to a file that is about to be replaced.
+
+    replace() swaps in a new file, starting with a header that names the
+    file it replaces and how much of it the new content covers. A reader
+    keeps its file open between reads, so read_new() can finish the old file
+    up to that point and carry on after the new file's head. It returns None
+    only if the log was replaced twice in between; the reader then has to
+    reload everything.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self._append_fd = None
+        self._read_fd = None
+        # Bytes of the file behind _read_fd already returned
+        self._offset = 0
+        # Replacements this reader has moved past, so owners can tell when
+        # someone else compacted
+        self.replacements = 0
+        # Guards the reader state, which replace() moves as well
+        self._reader_lock = threading.Lock()
+        # Per thread, so a thread holding the lock can re-enter it while
+        # other threads in this process still wait for it
+        self._held = threading.local()
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        """Hold the log's lock, shared by appends and exclusive for rewrites"""
+        if fcntl is None or getattr(self._held, 'depth', 0):
+            self._held.depth = getattr(self._held, 'depth', 0) + 1
+            try:
+                yield
+            finally:
+                self._held.depth -= 1
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._held.depth = 1
+            try:
+                yield
+            finally:
+                self._held.depth = 0
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _identity(stat):
+        return [stat.st_dev, stat.st_ino]
+
+    def _is_current(self, fd):
+        """Whether fd still refers to the file at path"""
+        return self._identity(os.fstat(fd)) == self._current_identity()
+
+    def _current_identity(self):
+        try:
+            return self._identity(os.stat(self.path))
+        except FileNotFoundError:
+            return None
+
+    def append(self, record):
+        """Append one record and return the bytes written"""
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self.locked():
+            if self._append_fd is not None and not self._is_current(self._append_fd):
+                os.close(self._append_fd)
+                self._append_fd = None
+            if self._append_fd is None:
+                self._append_fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._append_fd, line)
+        return len(line)
+
+    def reset(self):
+        """Read the current file from its start on the next read_new()"""
+        with self._reader_lock:
+            self._reset()
+
+    def _reset(self):
+        self._close_reader()
+        self._read_fd = os.open(self.path, os.O_RDONLY | os.O_CREAT, 0o644)
+        self._offset = 0
+        self.replacements += 1
+
+    def read_new(self):
+        """Records appended since the last read, or None if the log has to be reloaded"""
+        with self._reader_lock:
+            if self._read_fd is None:
+                self._reset()
+
+            records = []
+            if not self._is_current(self._read_fd) and not self._follow_replacement(records):
+                return None
+            records.extend(self._read_lines())
+            return records
+
+    def _follow_replacement(self, records):
+        """Finish the replaced file and move to the one that replaced it, if it says it follows ours"""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        first = os.pread(fd, 4096, 0)
+        try:
+            header = json.loads(first[:first.index(b'\n')])['$log']
+        except (ValueError, KeyError, TypeError):
+            header = None
+        if header is None or header['replaces'] != self._identity(os.fstat(self._read_fd)):
+            os.close(fd)
+            return False
+
+        records.extend(self._read_lines(end=header['through']))
+        # Lines past `through` were carried over, after the new content
+        carried = self._offset - header['through']
+        self._close_reader()
+        self._read_fd = fd
+        self._offset = first.index(b'\n') + 1 + header['skip'] + carried
+        self.replacements += 1
+        return True
+
+    def _read_lines(self, end=None):
+        """Parse the complete lines from the read offset up to end (or the end of the file)"""
+        chunks = []
+        position = self._offset
+        while end is None or position < end:
+            size = 1 << 20 if end is None else min(1 << 20, end - position)
+            chunk = os.pread(self._read_fd, size, position)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            position += len(chunk)
+        data = b''.join(chunks)
+
+        # A trailing line without a newline is still being written (or was
+        # torn by a crash); leave it for the next read
+        stop = data.rfind(b'\n') + 1
+        self._offset += stop
+
+        records = []
+        for line in data[:stop].splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not (isinstance(record, dict) and '$log' in record):
+                records.append(record)
+        return records
+
+    def mark(self):
+        """Where reading has got to, for a later replace()"""
+        with self._reader_lock:
+            if self._read_fd is None:
+                self._reset()
+            return self._identity(os.fstat(self._read_fd)), self._offset
+
+    def replace(self, payload=b'', mark=None):
+        """Swap in a new log that starts with payload in place of everything up to mark.
+
+        payload must cover every line before mark (by default, everything
+        read so far); lines after it are carried over. The new file is
+        written first and the exclusive lock is only taken to copy those
+        lines and rename it. Returns the bytes written, or None if the log
+        was replaced elsewhere since mark was taken.
+        """
+        identity, through = mark or self.mark()
+        if identity != self._current_identity():
+            return None
+        header = {'$log': {'replaces': identity, 'through': through, 'skip': len(payload)}}
+        header = (json.dumps(header, separators=(',', ':')) + '\n').encode('utf-8')
+        # Written outside the lock, so other writers need their own file
+        tmp_path = f"{self.path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+
+        with self.locked(exclusive=True), self._reader_lock:
+            if not self._is_current(self._read_fd) or identity != self._identity(os.fstat(self._read_fd)):
+                os.unlink(tmp_path)
+                return None
+            size = os.fstat(self._read_fd).st_size
+            tail = os.pread(self._read_fd, size - through, through) if size > through else b''
+            with open(tmp_path, 'ab') as f:
+                f.write(tail)
+            os.replace(tmp_path, self.path)
+
+            # Whatever was read past mark now sits after the payload
+            offset = len(header) + len(payload) + self._offset - through
+            self._reset()
+            self._offset = offset
+        return len(header) + len(payload) + len(tail)
+
+    def after_fork(self):
+        """Forget the parent's lock state; its file handles stay usable"""
+        self._held = threading.local()
+
+    def _close_reader(self):
+        if self._read_fd is not None:
+            os.close(self._read_fd)
+            self._read_fd = None
+
+    def close(self):
+        if self._append_fd is not None:
+            os.close(self._append_fd)
+            self._append_fd = None
+        self._close_reader()
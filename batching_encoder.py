@@ -0,0 +1,157 @@
+# batching_encoder.py
+import os
+import time
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+
+class _Request:
+    def __init__(self, texts):
+        self.texts = texts
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchingEncoder:
+    """Coalesces concurrent encode calls into one model batch.
+
+    Callers block in encode() while a worker thread gathers queued requests
+    (up to max_batch_size texts), runs encode_fn once on the lot and hands
+    each caller its rows. Requests arriving while a batch runs simply queue
+    for the next one; when the last batch served several callers, the worker
+    also holds a new batch open for up to max_wait seconds so a burst can
+    join it, while a lone caller on an idle encoder is not delayed at all.
+    Recently encoded texts are answered from an in-memory LRU cache without
+    touching the model.
+    """
+
+    def __init__(self, encode_fn, max_batch_size=64, max_wait=0.005, cache_size=1024):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.counters = {'requests': 0, 'cache_hits': 0, 'texts_encoded': 0, 'batches': 0}
+        self._cache = OrderedDict()
+        self.after_fork()
+
+    def after_fork(self):
+        """Drop the lock, queue and worker inherited from a parent process"""
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_cond = threading.Condition(self._lock)
+        self._worker_pid = None
+        self._last_batch_requests = 0
+
+    def encode(self, texts):
+        """Return a float32 matrix with one embedding per text"""
+        texts = list(texts)
+        rows = [None] * len(texts)
+        missing = OrderedDict()
+
+        with self._lock:
+            self.counters['requests'] += 1
+            for i, text in enumerate(texts):
+                cached = self._cache.get(text)
+                if cached is not None:
+                    self._cache.move_to_end(text)
+                    rows[i] = cached
+                    self.counters['cache_hits'] += 1
+                else:
+                    missing.setdefault(text, []).append(i)
+
+        if missing:
+            embeddings = self._encode_uncached(list(missing))
+            for (text, positions), embedding in zip(missing.items(), embeddings):
+                for i in positions:
+                    rows[i] = embedding
+
+        if not rows:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.array(rows, dtype=np.float32)
+
+    def _encode_uncached(self, texts):
+        # A request that fills a batch on its own (a CSV chunk, say) gains
+        # nothing from waiting, and would only flush the cache
+        if len(texts) >= self.max_batch_size:
+            embeddings = self._run_batch(texts, cache=False)
+        else:
+            request = _Request(texts)
+            with self._pending_cond:
+                self._ensure_worker()
+                self._pending.append(request)
+                self._pending_cond.notify()
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+            embeddings = request.result
+        return embeddings
+
+    def _ensure_worker(self):
+        # Started on first use, and again in a forked child, where the
+        # parent's thread does not exist
+        if self._worker_pid != os.getpid():
+            self._worker_pid = os.getpid()
+            thread = threading.Thread(target=self._worker, name="batching-encoder", daemon=True)
+            thread.start()
+
+    def _worker(self):
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+
+                # Under concurrent load, give other callers a moment to join
+                deadline = time.monotonic() + (self.max_wait if self._last_batch_requests > 1 else 0)
+                while sum(len(r.texts) for r in self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._pending_cond.wait(remaining)
+
+                batch, size = [], 0
+                while self._pending and (not batch or size + len(self._pending[0].texts) <= self.max_batch_size):
+                    request = self._pending.pop(0)
+                    batch.append(request)
+                    size += len(request.texts)
+                self._last_batch_requests = len(batch)
+
+            self._process(batch)
+
+    def _process(self, batch):
+        # Texts requested by several callers are encoded once
+        unique = list(OrderedDict.fromkeys(text for request in batch for text in request.texts))
+        try:
+            embeddings = self._run_batch(unique)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+
+        by_text = dict(zip(unique, embeddings))
+        for request in batch:
+            request.result = [by_text[text] for text in request.texts]
+            request.done.set()
+
+    def _run_batch(self, texts, cache=True):
+        embeddings = np.asarray(self.encode_fn(texts), dtype=np.float32)
+        with self._lock:
+            self.counters['batches'] += 1
+            self.counters['texts_encoded'] += len(texts)
+            if cache and self.cache_size:
+                for text, embedding in zip(texts, embeddings):
+                    self._cache[text] = embedding.copy()
+                    self._cache.move_to_end(text)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return embeddings
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['cache_size'] = len(self._cache)
+        stats['mean_batch_size'] = stats['texts_encoded'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
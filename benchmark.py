@@ -0,0 +1,854 @@
+# benchmark.py
+"""Offline benchmarks for the recommendation engine.
+
+    python benchmark.py backends --sizes 1000 10000 100000 1000000
+    python benchmark.py backends --filter '{"$and": [{"category": "Red Wine"}, {"price": {"$lte": 20}}]}'
+    python benchmark.py quantization --csv lcbo_wines_updated.csv --sizes 100000 1000000
+    python benchmark.py encoder --threads 1 8 32
+    python benchmark.py encoders --csv lcbo_wines_updated.csv
+    python benchmark.py --output baseline.json engine --sizes 1000 10000 100000 1000000 --sessions 1 8 32
+    python benchmark.py flask --sizes 1000 10000 --sessions 1 8
+    python benchmark.py compare baseline.json current.json --threshold 10
+
+Synthetic catalogues use random unit vectors of the MiniLM dimension, so no
+model download is needed. The quantization recall check on the real CSV
+embeds it with the configured model (through the on-disk embedding cache).
+
+The engine and flask load tests generate a catalogue CSV and a feedback
+history in a temporary directory, then drive the engine API (or the app's
+routes through Flask's test client) from concurrent simulated sessions, each
+browsing pages and clicking feedback. Each catalogue size runs in its own
+process so its peak RSS is its own. By default the model is replaced by a
+hashing encoder so results track the engine; --encoder onnx-int8 (etc.)
+includes the model. compare exits non-zero when a metric of the current
+report is worse than the baseline's by more than the threshold.
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timedelta
+
+from batching_encoder import BatchingEncoder
+from encoder_backends import ENCODER_BACKENDS, load_encoder
+from product_store import ProductStore
+from quantization import PRECISIONS
+from text_index import tokenize
+from vector_backends import ChromaBackend, NumpyBackend
+
+EMBEDDING_DIM = 384
+CATEGORIES = ['Red Wine', 'White Wine', 'Rosé Wine', 'Sparkling Wine']
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(samples, q) * 1000) if samples else None
+
+
+def latency_summary(samples):
+    return {
+        'n': len(samples),
+        'p50_ms': percentile_ms(samples, 50),
+        'p95_ms': percentile_ms(samples, 95),
+        'p99_ms': percentile_ms(samples, 99),
+    }
+
+
+def random_unit_vectors(n, dim=EMBEDDING_DIM, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def synthetic_store(n, dim=EMBEDDING_DIM, seed=0):
+    """A ProductStore of n placeholder products with random embeddings, prices and categories"""
+    rng = np.random.default_rng(seed)
+    prices = np.round(rng.uniform(8, 80, n), 2)
+    store = ProductStore()
+    for i, embedding in enumerate(random_unit_vectors(n, dim, seed)):
+        product = {
+            'id': str(i),
+            'name': f"Synthetic wine {i}",
+            'price': float(prices[i]),
+            'category': CATEGORIES[i % len(CATEGORIES)],
+        }
+        store.add(product, embedding)
+    return store
+
+
+def chroma_collection(store, batch_size=5000):
+    import chromadb
+    from chromadb.config import Settings
+
+    client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+    name = f"bench_{len(store)}_{time.time_ns()}"
+    collection = client.create_collection(name=name, metadata={"hnsw:space": "cosine"})
+    ids = store.ids()
+    embeddings = store.embeddings
+    for start in range(0, len(ids), batch_size):
+        stop = start + batch_size
+        collection.add(
+            ids=ids[start:stop],
+            embeddings=embeddings[start:stop].tolist(),
+            metadatas=[
+                {'product_id': p['id'], 'price': p['price'], 'category': p['category']}
+                for p in store[start:stop]
+            ]
+        )
+    return collection
+
+
+def time_queries(backend, queries, n_results, excluded_ids, where=None):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        backend.search([query], n_results, [excluded_ids], where)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_backends(args):
+    where = json.loads(args.filter) if args.filter else None
+    report = {'benchmark': 'backends', 'dim': EMBEDDING_DIM, 'n_results': args.n_results,
+              'filter': where, 'results': []}
+    queries = random_unit_vectors(args.queries, seed=1)
+
+    for size in args.sizes:
+        store = synthetic_store(size)
+        excluded = {str(i) for i in range(min(args.excluded, size))}
+        backends = [NumpyBackend(store)]
+        if size <= args.chroma_max:
+            build_start = time.perf_counter()
+            collection = chroma_collection(store)
+            backends.append(ChromaBackend(lambda: collection))
+            chroma_build_s = time.perf_counter() - build_start
+        else:
+            chroma_build_s = None
+
+        for backend in backends:
+            # Warm caches (norms, HNSW pages) before timing
+            time_queries(backend, queries[:5], args.n_results, excluded, where)
+            samples = time_queries(backend, queries, args.n_results, excluded, where)
+            result = {'backend': backend.name, 'catalogue_size': size, **latency_summary(samples)}
+            if backend.name == 'chroma':
+                result['build_s'] = chroma_build_s
+            report['results'].append(result)
+
+            # Batched queries are only meaningful for the in-process engine
+            if backend.name == 'numpy':
+                start = time.perf_counter()
+                backend.search(queries, args.n_results, [excluded] * len(queries), where)
+                elapsed = time.perf_counter() - start
+                report['results'].append({
+                    'backend': 'numpy-batched', 'catalogue_size': size,
+                    'queries_per_s': len(queries) / elapsed if elapsed > 0 else None
+                })
+
+        if size > args.chroma_max:
+            report['results'].append({'backend': 'chroma', 'catalogue_size': size, 'skipped': True})
+
+    return report
+
+
+def scratch_engine(tmp, cache_dir, **kwargs):
+    """A lazy engine whose catalogue and feedback files live in tmp"""
+    from recommendation_engine import ProductRecommendationEngine
+
+    kwargs.setdefault('vector_backend', "numpy")
+    return ProductRecommendationEngine(
+        db_path=os.path.join(tmp, 'chroma_db'),
+        products_path=os.path.join(tmp, 'products.json'),
+        feedback_path=os.path.join(tmp, 'feedback.json'),
+        cache_dir=cache_dir,
+        lazy=True,
+        **kwargs
+    )
+
+
+def csv_texts(csv_path):
+    """The CSV products and the texts the engine embeds for them"""
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = scratch_engine(tmp, os.path.join(tmp, 'cache'))
+        products = [product for product, _ in engine._read_csv_products(csv_path)]
+        return products, [engine._get_product_text(p) for p in products]
+
+
+def csv_store(csv_path, cache_dir):
+    """A ProductStore of the CSV catalogue with real model embeddings"""
+    products, texts = csv_texts(csv_path)
+    with tempfile.TemporaryDirectory() as tmp:
+        embeddings = scratch_engine(tmp, cache_dir)._encode_texts(texts)
+
+    store = ProductStore()
+    for product, embedding in zip(products, embeddings):
+        store.add(product, embedding)
+    return store
+
+
+def recall_at_k(exact, approximate):
+    hits = [len(set(e) & set(a)) / len(e) for e, a in zip(exact, approximate) if e]
+    return float(np.mean(hits)) if hits else None
+
+
+def compare_precisions(store, queries, excluded, args):
+    """Recall@k, memory and latency of each compressed backend against float32"""
+    k_max = max(args.k)
+    baseline = NumpyBackend(store)
+    exact = [baseline.search([query], k_max, [ex])[0] for query, ex in zip(queries, excluded)]
+    float32_bytes = store.embeddings.nbytes
+
+    results = [{
+        'precision': 'float32', 'rerank_factor': None, 'matrix_bytes': float32_bytes,
+        **latency_summary(time_queries(baseline, queries, k_max, set()))
+    }]
+    for precision in PRECISIONS[1:]:
+        for rerank_factor in (0, args.rerank_factor):
+            backend = NumpyBackend(store, precision=precision, rerank_factor=rerank_factor)
+            backend.quantized()
+            approximate = [backend.search([query], k_max, [ex])[0] for query, ex in zip(queries, excluded)]
+            result = {
+                'precision': precision,
+                'rerank_factor': rerank_factor,
+                'matrix_bytes': backend.quantized().nbytes,
+                'compression': float32_bytes / backend.quantized().nbytes,
+            }
+            for k in args.k:
+                result[f'recall@{k}'] = recall_at_k([e[:k] for e in exact], [a[:k] for a in approximate])
+            result.update(latency_summary(time_queries(backend, queries, k_max, set())))
+            results.append(result)
+    return results
+
+
+def bench_quantization(args):
+    report = {'benchmark': 'quantization', 'dim': EMBEDDING_DIM, 'k': args.k, 'results': []}
+
+    # Real embeddings: every product queries for its nearest other products
+    if args.csv:
+        store = csv_store(args.csv, args.cache_dir)
+        queries = store.embeddings.copy()
+        excluded = [{product_id} for product_id in store.ids()]
+        report['results'].append({
+            'catalogue': args.csv, 'catalogue_size': len(store),
+            'precisions': compare_precisions(store, queries, excluded, args)
+        })
+
+    # Random vectors are the hardest case for recall, and show scan cost at scale
+    for size in args.sizes:
+        store = synthetic_store(size)
+        queries = random_unit_vectors(args.queries, seed=1)
+        report['results'].append({
+            'catalogue': 'synthetic', 'catalogue_size': size,
+            'precisions': compare_precisions(store, queries, [set()] * len(queries), args)
+        })
+
+    return report
+
+
+def concurrent_encodes(encode, threads, requests_per_thread):
+    """Encode one unique text per call from several threads; return (latencies, elapsed)"""
+    samples = []
+    lock = threading.Lock()
+
+    def client(worker):
+        local = []
+        for i in range(requests_per_thread):
+            text = f"Wine: synthetic {worker}-{i}. Description: dark fruit, cedar and a note of graphite."
+            start = time.perf_counter()
+            encode([text])
+            local.append(time.perf_counter() - start)
+        with lock:
+            samples.extend(local)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=client, args=(worker,)) for worker in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return samples, time.perf_counter() - start
+
+
+def bench_encoder(args):
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(args.model)
+    model.encode(["warm up"])
+    report = {'benchmark': 'encoder', 'model': args.model, 'results': []}
+
+    for threads in args.threads:
+        # The LRU cache is off so every call reaches the model
+        encoders = {
+            'direct': lambda texts: model.encode(texts),
+            'batching': BatchingEncoder(model.encode, max_wait=args.max_wait, cache_size=0).encode,
+        }
+        for name, encode in encoders.items():
+            samples, elapsed = concurrent_encodes(encode, threads, args.requests)
+            report['results'].append({
+                'encoder': name, 'threads': threads,
+                'texts_per_s': len(samples) / elapsed,
+                **latency_summary(samples)
+            })
+    return report
+
+
+COLD_START = """
+import json, resource, sys, time
+start = time.perf_counter()
+from encoder_backends import load_encoder
+model = load_encoder(sys.argv[1], sys.argv[2], sys.argv[3])
+model.encode(["warm up"])
+elapsed = time.perf_counter() - start
+# ru_maxrss survives exec on Linux (it would report the parent's peak), so
+# prefer the kernel's per-address-space high-water mark
+try:
+    with open('/proc/self/status') as f:
+        peak_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+except (OSError, StopIteration):
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'cold_start_s': elapsed,
+    'peak_rss_mb': peak_kb / 1024,
+    'imports_torch': 'torch' in sys.modules,
+}))
+"""
+
+
+def cold_start(model_name, backend, onnx_dir):
+    """Import, load and first-encode time of a backend in a fresh interpreter"""
+    output = subprocess.run(
+        [sys.executable, '-c', COLD_START, model_name, backend, onnx_dir],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench_encoders(args):
+    _, texts = csv_texts(args.csv)
+    report = {'benchmark': 'encoders', 'model': args.model, 'texts': len(texts), 'results': []}
+
+    reference = None
+    for backend in args.backends:
+        # Exports happen here, so the cold start below only measures loading
+        model = load_encoder(args.model, backend, args.onnx_dir)
+        model.encode(texts[:8])
+
+        start = time.perf_counter()
+        embeddings = model.encode(texts, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+
+        result = {'backend': backend, 'texts_per_s': len(texts) / elapsed}
+        if reference is None:
+            reference = embeddings
+        else:
+            # Parity with the first backend (torch by default)
+            cosines = np.sum(reference * embeddings, axis=1) / (
+                np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1))
+            result.update({
+                'cosine_min': float(cosines.min()),
+                'cosine_mean': float(cosines.mean()),
+                'cosine_p1': float(np.percentile(cosines, 1)),
+            })
+        result.update(cold_start(args.model, backend, args.onnx_dir))
+        report['results'].append(result)
+    return report
+
+
+GRAPES = ['Cabernet Sauvignon', 'Merlot', 'Pinot Noir', 'Malbec', 'Syrah', 'Tempranillo', 'Sangiovese',
+          'Chardonnay', 'Sauvignon Blanc', 'Riesling', 'Pinot Grigio', 'Chenin Blanc', 'Gamay', 'Grenache']
+COUNTRIES = ['France', 'Italy', 'Spain', 'Argentina', 'Chile', 'Canada', 'United States', 'Australia',
+             'Portugal', 'Germany', 'New Zealand', 'South Africa']
+DESCRIPTORS = ['cherry', 'plum', 'cassis', 'raspberry', 'blackberry', 'vanilla', 'cedar', 'tobacco', 'leather',
+               'pepper', 'citrus', 'apple', 'pear', 'peach', 'honey', 'mineral', 'floral', 'oak', 'toast',
+               'earthy', 'silky', 'firm', 'tannic', 'crisp', 'buttery', 'juicy', 'spicy', 'smoky', 'herbal']
+SYLLABLES = ['ca', 'sa', 'vi', 'mon', 'ter', 'ro', 'la', 'del', 'san', 'bel', 'cor', 'ta', 'ne', 'ri', 'bo', 'val']
+
+
+class HashingEncoder:
+    """Deterministic stand-in for the sentence model.
+
+    Each word adds +1 or -1 to a hashed dimension and rows are normalized,
+    so products that share words get similar vectors and the vector search
+    has realistic work to do. It costs microseconds per text, which keeps
+    the engine and Flask benchmarks about the engine rather than the model.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            rows, columns, signs = [], [], []
+            for row, text in enumerate(texts[start:start + batch_size], start):
+                for word in tokenize(text):
+                    digest = zlib.crc32(word.encode('utf-8'))
+                    rows.append(row)
+                    columns.append(digest % self.dim)
+                    signs.append(1.0 if digest & 0x10000 else -1.0)
+            np.add.at(embeddings, (rows, columns), signs)
+
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+
+def bench_model(name, model_name, onnx_dir):
+    """The encoder a benchmark engine runs: the hashing stand-in or a real backend"""
+    if name == 'hashing':
+        return HashingEncoder()
+    return load_encoder(model_name, name, onnx_dir)
+
+
+def synthetic_catalogue_csv(path, n, seed=0):
+    """Write n wine rows with the LCBO CSV columns the engine reads; returns their IDs"""
+    rng = np.random.default_rng(seed)
+    producers = np.array([a.title() + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES[:8]])
+    grapes = np.array(GRAPES)
+    grape = rng.integers(len(grapes), size=n)
+    words = np.array(DESCRIPTORS)[rng.integers(len(DESCRIPTORS), size=(n, 8))]
+    ids = np.arange(100000, 100000 + n).astype(str)
+
+    frame = pd.DataFrame({
+        'permanent_id': ids,
+        'title': (pd.Series(producers[rng.integers(len(producers), size=n)]) + ' ' + grapes[grape]
+                  + ' ' + rng.integers(2005, 2024, size=n).astype(str)),
+        'brand': producers[rng.integers(len(producers), size=n)],
+        'category': 'Wine',
+        'subcategory': np.array(CATEGORIES)[grape % len(CATEGORIES)],
+        'price': np.round(rng.lognormal(3.0, 0.5, size=n), 2),
+        'alcohol_content': np.round(rng.uniform(11, 15.5, size=n), 1),
+        'country': np.array(COUNTRIES)[rng.integers(len(COUNTRIES), size=n)],
+        'image_url': '',
+        'rating': np.where(rng.random(n) < 0.3, np.round(rng.uniform(3, 5, size=n), 1).astype(str), ''),
+        'description': ['Aromas of ' + ', '.join(row[:4]) + '; ' + ' and '.join(row[4:]) + ' on the palate.'
+                        for row in words],
+    })
+    frame.to_csv(path, index=False)
+    return ids.tolist()
+
+
+def synthetic_feedback(path, product_ids, users, seed=0):
+    """Write a feedback snapshot shaped like data/feedback.json; returns the user IDs"""
+    rng = np.random.default_rng(seed)
+    feedback = {'users': {}}
+    start = datetime(2025, 1, 1)
+    for i in range(users):
+        picks = rng.choice(len(product_ids), size=min(len(product_ids), 1 + rng.geometric(0.08)), replace=False)
+        # About three likes for every dislike, as in the real snapshot
+        split = max(1, int(len(picks) * 0.75))
+        liked = [product_ids[row] for row in picks[:split]]
+        disliked = [product_ids[row] for row in picks[split:]]
+        feedback['users'][f"bench-user-{i}"] = {
+            'likes': liked,
+            'dislikes': disliked,
+            'timestamps': {product_id: (start + timedelta(minutes=int(minute))).isoformat()
+                           for product_id, minute in zip(liked + disliked, rng.integers(0, 500000, size=len(picks)))}
+        }
+    with open(path, 'w') as f:
+        json.dump(feedback, f)
+    return list(feedback['users'])
+
+
+def run_sessions(sessions, session_fn):
+    """Run session_fn(session, record) on concurrent threads; record(operation, seconds) collects latencies"""
+    samples = {}
+    lock = threading.Lock()
+
+    def client(session):
+        local = {}
+        session_fn(session, lambda operation, seconds: local.setdefault(operation, []).append(seconds))
+        with lock:
+            for operation, values in local.items():
+                samples.setdefault(operation, []).extend(values)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(session,)) for session in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def session_user(session, sessions, users):
+    """Alternate between users with a feedback history and brand-new ones"""
+    if session % 2 == 0 and users:
+        return users[(sessions + session) % len(users)]
+    return f"bench-session-{sessions}-{session}"
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far"""
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+    except (OSError, StopIteration):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def engine_size_results(options):
+    """Load, feedback and browsing latencies of a scratch engine over one synthetic catalogue"""
+    size = options['catalogue_size']
+    results = []
+
+    def result(operation, **values):
+        results.append({'catalogue_size': size, 'operation': operation, **values})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'catalogue.csv')
+        product_ids = synthetic_catalogue_csv(csv_path, size)
+        users = synthetic_feedback(os.path.join(tmp, 'feedback.json'), product_ids, options['users'])
+
+        # The neighbour graph is timed on its own below
+        engine = scratch_engine(tmp, os.path.join(tmp, 'cache'), vector_backend=options['vector_backend'],
+                                feedback_mode=options['feedback_mode'], neighbour_k=0)
+        engine._model = bench_model(options['encoder'], options['model'], options['onnx_dir'])
+
+        # The CSV load writes every row to Chroma as well, which is what
+        # dominates it; past load_max the numpy backend is filled directly
+        start = time.perf_counter()
+        if size <= options['load_max'] or options['vector_backend'] == 'chroma':
+            operation = 'load_products_from_csv'
+            engine.load_products_from_csv(csv_path)
+        else:
+            operation = 'build_catalogue'
+            engine.products.reset(product for product, _ in engine._read_csv_products(csv_path))
+        engine.warm_up()
+        elapsed = time.perf_counter() - start
+        result(operation, elapsed_s=elapsed, rows_per_s=len(engine.products) / elapsed)
+
+        # Full rebuilds from the synthetic history, as on a user's first request
+        samples = []
+        for user_id in users[:options['queries']]:
+            start = time.perf_counter()
+            engine.update_user_preference(user_id)
+            samples.append(time.perf_counter() - start)
+        engine.preference_state.clear()
+        result('update_user_preference', **latency_summary(samples))
+
+        # The graph build is quadratic in the catalogue size; past
+        # neighbour_max similar products come from vector queries
+        if options['neighbour_k'] and size <= options['neighbour_max']:
+            engine.neighbour_k = options['neighbour_k']
+            start = time.perf_counter()
+            engine.build_neighbours()
+            result('build_neighbours', k=options['neighbour_k'], elapsed_s=time.perf_counter() - start)
+
+        # Similar products from the graph, against the vector query it replaces
+        rng = np.random.default_rng(0)
+        sampled_rows = rng.integers(len(engine.products), size=options['queries'])
+        sampled_ids = [engine.products[int(row)]['id'] for row in sampled_rows]
+        for operation, similar in (
+            ('get_similar_products', lambda product_id: engine.get_similar_products(product_id)),
+            ('similar_vector_search', lambda product_id: engine._search(
+                [engine.products.embedding(product_id)], 5, [{product_id}])),
+        ):
+            samples = []
+            for product_id in sampled_ids:
+                start = time.perf_counter()
+                similar(product_id)
+                samples.append(time.perf_counter() - start)
+            result(operation, **latency_summary(samples))
+
+        for sessions in options['sessions']:
+            def browse(session, record):
+                rng = np.random.default_rng(session)
+                user_id = session_user(session, sessions, users)
+                engine.clear_viewed_history(user_id)
+                for _ in range(options['pages']):
+                    start = time.perf_counter()
+                    products = engine.get_recommendations(user_id, n_results=3, record_views=True)
+                    record('get_recommendations', time.perf_counter() - start)
+                    if products:
+                        start = time.perf_counter()
+                        engine.add_feedback(user_id, products[0]['id'], 'up' if rng.random() < 0.7 else 'down')
+                        record('add_feedback', time.perf_counter() - start)
+
+            samples, elapsed = run_sessions(sessions, browse)
+            engine.drain_feedback_queue()
+            result('sessions', sessions=sessions, ops_per_s=sum(map(len, samples.values())) / elapsed)
+            for operation, values in samples.items():
+                result(operation, sessions=sessions, **latency_summary(values))
+
+        engine.products_writer.flush(force=True)
+        result('recommendation_cache', **engine.recommendation_cache.stats())
+        result('process', peak_rss_mb=peak_rss_mb())
+    return results
+
+
+PRODUCT_ID_PATTERN = re.compile(r'class="col-md-4 mb-4 product-card" data-product-id="([^"]+)"')
+
+
+def flask_size_results(options):
+    """Latency of the / and /feedback routes through the Flask test client over one synthetic catalogue"""
+    size = options['catalogue_size']
+    results = []
+
+    def result(operation, **values):
+        results.append({'catalogue_size': size, 'operation': operation, **values})
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    with tempfile.TemporaryDirectory() as tmp:
+        # app.py reads its catalogue, data files and Chroma path relative to
+        # the working directory
+        os.chdir(tmp)
+        os.makedirs('data')
+        product_ids = synthetic_catalogue_csv('lcbo_wines_updated.csv', size)
+        synthetic_feedback(os.path.join('data', 'feedback.json'), product_ids, options['users'])
+        os.environ['FEEDBACK_MODE'] = options['feedback_mode']
+
+        # app.py builds its engine on import; give it the benchmark's encoder
+        import recommendation_engine
+        recommendation_engine.load_encoder = lambda *args: bench_model(options['encoder'], options['model'],
+                                                                       os.path.join(repo_dir, options['onnx_dir']))
+        start = time.perf_counter()
+        import app as flask_app
+        if not flask_app.engine.ready.wait(options['warmup_timeout']):
+            raise RuntimeError(f"Engine not ready after {options['warmup_timeout']}s: {flask_app.engine.warmup_error}")
+        result('warm_up', elapsed_s=time.perf_counter() - start)
+
+        for sessions in options['sessions']:
+            cookie_bytes = []
+
+            def browse(session, record):
+                rng = np.random.default_rng(session)
+                client = flask_app.app.test_client()
+                shown = []
+                for page in range(options['pages']):
+                    # A full page load every few clicks; clicks fetch the next
+                    # products through /feedback
+                    if page % 5 == 0 or not shown:
+                        start = time.perf_counter()
+                        html = client.get('/').get_data(as_text=True)
+                        record('GET /', time.perf_counter() - start)
+                        shown = list(dict.fromkeys(PRODUCT_ID_PATTERN.findall(html)))
+                        if not shown:
+                            break
+                    start = time.perf_counter()
+                    response = client.post('/feedback', json={
+                        'product_id': shown[0],
+                        'feedback': 'up' if rng.random() < 0.7 else 'down'
+                    })
+                    record('POST /feedback', time.perf_counter() - start)
+                    shown = [product['id'] for product in response.get_json()['new_products']]
+                cookie = client.get_cookie('session')
+                cookie_bytes.append(len(cookie.value) if cookie else 0)
+
+            samples, elapsed = run_sessions(sessions, browse)
+            flask_app.engine.drain_feedback_queue()
+            result('sessions', sessions=sessions, requests_per_s=sum(map(len, samples.values())) / elapsed)
+            for operation, values in samples.items():
+                result(operation, sessions=sessions, **latency_summary(values))
+            result('session_cookie', sessions=sessions, max_bytes=max(cookie_bytes), mean_bytes=float(np.mean(cookie_bytes)))
+
+        flask_app.engine.products_writer.flush(force=True)
+        result('process', peak_rss_mb=peak_rss_mb())
+        os.chdir(repo_dir)
+    return results
+
+
+ISOLATED = """
+import json, sys
+import benchmark
+print(json.dumps(getattr(benchmark, sys.argv[1])(json.loads(sys.argv[2]))))
+"""
+
+
+def isolated(function_name, options):
+    """Run a benchmark function in a fresh interpreter, so peak RSS belongs to that run alone"""
+    output = subprocess.run(
+        [sys.executable, '-c', ISOLATED, function_name, json.dumps(options)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def load_test_options(args):
+    return {
+        'encoder': args.encoder, 'model': args.model, 'onnx_dir': args.onnx_dir,
+        'users': args.users, 'sessions': args.sessions, 'pages': args.pages,
+        'feedback_mode': args.feedback_mode,
+    }
+
+
+def bench_engine(args):
+    options = {**load_test_options(args), 'vector_backend': args.vector_backend, 'queries': args.queries,
+               'load_max': args.load_max, 'neighbour_k': args.neighbour_k, 'neighbour_max': args.neighbour_max}
+    report = {'benchmark': 'engine', **options, 'results': []}
+    for size in args.sizes:
+        report['results'].extend(isolated('engine_size_results', {**options, 'catalogue_size': size}))
+    return report
+
+
+def bench_flask(args):
+    options = {**load_test_options(args), 'warmup_timeout': args.warmup_timeout}
+    report = {'benchmark': 'flask', **options, 'results': []}
+    for size in args.sizes:
+        report['results'].extend(isolated('flask_size_results', {**options, 'catalogue_size': size}))
+    return report
+
+
+# Fields that say what a result measured, as opposed to how it did
+IDENTITY_FIELDS = ('benchmark', 'catalogue', 'catalogue_size', 'backend', 'precision', 'rerank_factor',
+                   'encoder', 'threads', 'operation', 'sessions')
+
+
+def metric_direction(name):
+    """+1 if a bigger value is better, -1 if smaller is, None if the field is not compared"""
+    if name.endswith('_per_s') or name.startswith('recall@') or name in ('hit_rate', 'compression'):
+        return 1
+    if name.endswith('_ms') or name.endswith('_s') or name.endswith('_mb') or name.endswith('_bytes'):
+        return -1
+    return None
+
+
+def flatten_results(node, identity=()):
+    """Yield (identity, metrics) for every result row of a report, nested ones included"""
+    if isinstance(node, list):
+        for item in node:
+            yield from flatten_results(item, identity)
+        return
+    if not isinstance(node, dict):
+        return
+    # The top-level options repeat some fields as lists (e.g. every sessions count)
+    identity = identity + tuple((field, node[field]) for field in IDENTITY_FIELDS
+                                if field in node and not isinstance(node[field], (list, dict)))
+    metrics = {name: value for name, value in node.items()
+               if isinstance(value, (int, float)) and not isinstance(value, bool)
+               and name not in IDENTITY_FIELDS and metric_direction(name)}
+    if metrics:
+        yield identity, metrics
+    for value in node.values():
+        if isinstance(value, (list, dict)):
+            yield from flatten_results(value, identity)
+
+
+def bench_compare(args):
+    with open(args.baseline) as f:
+        baseline = dict(flatten_results(json.load(f)))
+    with open(args.current) as f:
+        current = list(flatten_results(json.load(f)))
+
+    report = {'benchmark': 'compare', 'baseline': args.baseline, 'current': args.current,
+              'threshold_pct': args.threshold, 'regressions': 0, 'results': []}
+    for identity, metrics in current:
+        before = baseline.get(identity)
+        if before is None:
+            continue
+        for name, value in metrics.items():
+            if not before.get(name):
+                continue
+            change_pct = (value - before[name]) / abs(before[name]) * 100
+            regression = -metric_direction(name) * change_pct > args.threshold
+            report['regressions'] += regression
+            report['results'].append({**dict(identity), 'metric': name, 'baseline': before[name],
+                                      'current': value, 'change_pct': change_pct, 'regression': regression})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help="Write the JSON report to this file as well as stdout")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    backends = subparsers.add_parser('backends', help="Compare Chroma and NumPy query latency")
+    backends.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    backends.add_argument('--queries', type=int, default=200)
+    backends.add_argument('--n-results', type=int, default=3)
+    backends.add_argument('--excluded', type=int, default=20, help="Viewed IDs excluded per query")
+    backends.add_argument('--chroma-max', type=int, default=100000,
+                          help="Largest catalogue to load into Chroma (building its index is slow)")
+    backends.add_argument('--filter', help="Where clause (JSON) applied to every query, over price and category")
+    backends.set_defaults(run=bench_backends)
+
+    quantization = subparsers.add_parser('quantization', help="Recall and cost of float16/int8 catalogue embeddings")
+    quantization.add_argument('--csv', help="Catalogue CSV to embed for the recall check, e.g. lcbo_wines_updated.csv")
+    quantization.add_argument('--cache-dir', default="data/embedding_cache")
+    quantization.add_argument('--sizes', type=int, nargs='*', default=[100000])
+    quantization.add_argument('--queries', type=int, default=100)
+    quantization.add_argument('--k', type=int, nargs='+', default=[3, 10])
+    quantization.add_argument('--rerank-factor', type=int, default=4)
+    quantization.set_defaults(run=bench_quantization)
+
+    encoder = subparsers.add_parser('encoder', help="Single-text encode throughput with and without micro-batching")
+    encoder.add_argument('--model', default='sentence-transformers/all-MiniLM-L6-v2')
+    encoder.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    encoder.add_argument('--requests', type=int, default=50, help="Encode calls per thread")
+    encoder.add_argument('--max-wait', type=float, default=0.005)
+    encoder.set_defaults(run=bench_encoder)
+
+    encoders = subparsers.add_parser('encoders', help="Parity, throughput and cold start of the encoder backends")
+    encoders.add_argument('--csv', default='lcbo_wines_updated.csv', help="Catalogue whose product texts are encoded")
+    encoders.add_argument('--model', default='sentence-transformers/all-MiniLM-L6-v2',
+                          help="Model name in the local Hugging Face cache, or a path (set HF_HUB_OFFLINE=1 offline)")
+    encoders.add_argument('--backends', nargs='+', default=list(ENCODER_BACKENDS), choices=ENCODER_BACKENDS)
+    encoders.add_argument('--onnx-dir', default='data/onnx')
+    encoders.add_argument('--batch-size', type=int, default=32)
+    encoders.set_defaults(run=bench_encoders)
+
+    # Shared by the engine and flask load tests
+    load_test = argparse.ArgumentParser(add_help=False)
+    load_test.add_argument('--encoder', default='hashing', choices=('hashing',) + ENCODER_BACKENDS,
+                           help="hashing times the engine alone; a real backend adds the model's cost")
+    load_test.add_argument('--model', default='sentence-transformers/all-MiniLM-L6-v2')
+    load_test.add_argument('--onnx-dir', default='data/onnx')
+    load_test.add_argument('--users', type=int, default=1000, help="Users in the synthetic feedback history")
+    load_test.add_argument('--sessions', type=int, nargs='+', default=[1, 8], help="Concurrent simulated sessions")
+    load_test.add_argument('--pages', type=int, default=20, help="Pages (each with one feedback click) per session")
+    load_test.add_argument('--feedback-mode', default='sync', choices=('sync', 'async'))
+
+    engine = subparsers.add_parser('engine', parents=[load_test],
+                                   help="Engine API latency, throughput and peak RSS over synthetic catalogues")
+    engine.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    engine.add_argument('--vector-backend', default='numpy', choices=('numpy', 'chroma'))
+    engine.add_argument('--queries', type=int, default=200, help="Users whose preference vector is rebuilt")
+    engine.add_argument('--load-max', type=int, default=100000,
+                        help="Largest catalogue loaded through load_products_from_csv (numpy backend only)")
+    engine.add_argument('--neighbour-k', type=int, default=20, help="Neighbours per product in the similarity graph")
+    engine.add_argument('--neighbour-max', type=int, default=100000,
+                        help="Largest catalogue the (quadratic) neighbour graph is built for")
+    engine.set_defaults(run=bench_engine)
+
+    flask = subparsers.add_parser('flask', parents=[load_test],
+                                  help="Latency of the / and /feedback routes through the Flask test client")
+    flask.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    flask.add_argument('--warmup-timeout', type=float, default=1800)
+    flask.set_defaults(run=bench_flask)
+
+    compare = subparsers.add_parser('compare', help="Compare two JSON reports metric by metric")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=10.0,
+                         help="Percent change in the wrong direction that counts as a regression")
+    compare.set_defaults(run=bench_compare)
+
+    args = parser.parse_args()
+    report = args.run(args)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+# build_neighbours.py
+"""Compute the neighbour graph for the saved catalogue and save it next to it.
+
+Building the graph is quadratic in the catalogue size, so with
+ENGINE_MODE=shared the Gunicorn master only maps a graph saved earlier.
+Run this once the catalogue has been synced (after a deploy that changed
+the CSV, say); workers without a graph pick the new one up on their next
+request, and until then similar products come from vector queries.
+
+    ENCODER_BACKEND=onnx python build_neighbours.py  # as the app is run
+"""
+import os
+
+from recommendation_engine import ProductRecommendationEngine
+
+
+if __name__ == '__main__':
+    # The graph only needs the catalogue matrix, not ChromaDB. Each encoder
+    # backend embeds a little differently, and a graph built from another
+    # backend's matrix does not match the app's catalogue, so this reads
+    # ENCODER_BACKEND as app.py does
+    engine = ProductRecommendationEngine(lazy=True, vector_backend="numpy",
+                                         encoder_backend=os.environ.get('ENCODER_BACKEND', 'torch'))
+    graph = engine.build_neighbours()
+    print(f"Neighbour graph for {len(graph)} products saved to {engine.neighbours_path}")
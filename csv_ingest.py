@@ -0,0 +1,255 @@
+# csv_ingest.py
+"""Columnar parsing of the LCBO catalogue CSV into (product, metadata) pairs.
+
+The file is read in one pass with pandas (the pyarrow engine when it is
+installed, otherwise the C engine in chunks), every column as a string and
+without NA conversion, so text fields and content hashes are exactly what
+the row-by-row reader produced. Numbers are coerced column-wise and rows
+that cannot be used are collected with a reason instead of printed.
+"""
+import os
+import csv
+import re
+import json
+import math
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+
+REJECT_FIELDS = ['line', 'permanent_id', 'title', 'reason']
+BAD_LINE_PATTERN = re.compile(r"Skipping line (\d+): (.*)")
+
+
+# Same output as json.dumps(..., sort_keys=True), without building an
+# encoder for every row
+_HASH_ENCODER = json.JSONEncoder(sort_keys=True)
+
+
+def content_hash(product, metadata):
+    """Fingerprint of everything that ends up in the vector store for a product"""
+    payload = _HASH_ENCODER.encode([product, metadata])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _pyarrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def read_csv_chunks(csv_path, chunksize=50000):
+    """Yield (DataFrame of string columns, their lines, malformed lines) covering the whole file.
+
+    Lines are CSV records counted from the header as line 1. Rows with more
+    fields than the header (and, with pyarrow, fewer) are left out of the
+    frames and come back as (line, message) pairs.
+    """
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        # The C engine sizes rows by the first one it parses: over-long
+        # leading rows would turn the first column into the index (or, with
+        # index_col=False, have every longer row cut short), so they are
+        # skipped up front
+        leading = []
+        for line, row in enumerate(reader, start=2):
+            if len(row) <= len(header):
+                break
+            leading.append((line, f"expected {len(header)} fields, saw {len(row)}"))
+
+    options = {'dtype': str, 'keep_default_na': False}
+    if _pyarrow_available():
+        # pyarrow parses on several threads but cannot stream chunks, and
+        # does not know the lines of the rows it skips; those are found with
+        # a second pass, when there are any
+        skipped = []
+
+        def skip(row):
+            skipped.append(row)
+            return 'skip'
+
+        df = pd.read_csv(csv_path, engine='pyarrow', on_bad_lines=skip, **options)
+        malformed = _malformed_lines(csv_path, len(header)) if skipped else []
+        yield df, _frame_lines(df, 2, malformed)[0], malformed
+        return
+
+    # index_col=False: a stray trailing field must not turn the first column
+    # into the index
+    next_line = 2
+    with pd.read_csv(csv_path, chunksize=chunksize, index_col=False, on_bad_lines='warn',
+                     skiprows=[line - 1 for line, _ in leading], **options) as reader:
+        while True:
+            try:
+                df, malformed = _parse(reader.get_chunk)
+            except StopIteration:
+                return
+            malformed, leading = leading + malformed, []
+            lines, next_line = _frame_lines(df, next_line, malformed)
+            yield df, lines, malformed
+
+
+def _frame_lines(df, first_line, malformed):
+    """Lines of a frame's rows: the span it was read from minus the lines the parser skipped.
+
+    Returns them with the line after the span.
+    """
+    skipped = [line for line, _ in malformed if line is not None]
+    span = np.arange(first_line, first_line + len(df) + len(skipped))
+    lines = np.setdiff1d(span, skipped, assume_unique=True)[:len(df)]
+    return lines, int(span[-1]) + 1 if len(span) else first_line
+
+
+def _malformed_lines(csv_path, fields):
+    """(line, message) for every record without the given number of fields"""
+    malformed = []
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for line, row in enumerate(reader, start=2):
+            if row and len(row) != fields:
+                malformed.append((line, f"expected {fields} fields, saw {len(row)}"))
+    return malformed
+
+
+def _parse(read):
+    """Run a pandas read, collecting the lines it skipped from its warnings"""
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', pd.errors.ParserWarning)
+        df = read()
+
+    malformed = []
+    for warning in caught:
+        # One warning may list several lines of a chunk
+        matches = BAD_LINE_PATTERN.findall(str(warning.message))
+        if matches:
+            malformed.extend((int(line), message.strip()) for line, message in matches)
+        elif issubclass(warning.category, pd.errors.ParserWarning):
+            malformed.append((None, str(warning.message).strip()))
+        else:
+            warnings.warn_explicit(warning.message, warning.category, warning.filename, warning.lineno)
+    return df, malformed
+
+
+def _numbers(values):
+    """Parse a string column to floats; blanks and junk become NaN"""
+    return pd.to_numeric(values.str.strip(), errors='coerce').to_numpy(dtype=np.float64)
+
+
+class CatalogueReader:
+    """Turns catalogue CSV files into (product, metadata) pairs, recording rejected rows"""
+
+    def __init__(self, chunksize=50000):
+        self.chunksize = chunksize
+        self.rejects = []
+
+    def read(self, csv_path):
+        """Return the usable, unique rows of a CSV file in file order"""
+        self.rejects = []
+        seen_ids = set()
+        entries = []
+        for chunk, lines, malformed in read_csv_chunks(csv_path, self.chunksize):
+            for line, message in malformed:
+                self.rejects.append({'line': line, 'permanent_id': '', 'title': '', 'reason': f"malformed row: {message}"})
+            entries.extend(self._chunk_entries(chunk, lines, seen_ids))
+        self.rejects.sort(key=lambda reject: reject['line'] or 0)
+        return entries
+
+    def _chunk_entries(self, df, lines, seen_ids):
+        n = len(df)
+
+        def column(name, default=''):
+            if name in df.columns:
+                return df[name]
+            return pd.Series([default] * n, index=df.index, dtype=object)
+
+        ids = column('permanent_id')
+        titles = column('title')
+        # The subcategory (e.g. "Red Wine") is the useful category when present
+        categories = df['subcategory'] if 'subcategory' in df.columns else column('category')
+        countries = column('country')
+        brands = column('brand')
+        alcohol = column('alcohol_content', '0')
+        ratings = column('rating', '0')
+
+        # Prices: strip currency formatting; blank means 0.0, anything else
+        # unparseable is a bad row
+        price_text = column('price').str.replace(r'[$,\s]', '', regex=True)
+        prices = pd.to_numeric(price_text, errors='coerce').to_numpy(dtype=np.float64, copy=True)
+        blank_price = (price_text == '').to_numpy()
+        prices[blank_price] = 0.0
+        abv = _numbers(alcohol)
+        rating_values = _numbers(ratings)
+
+        # Vectorized validity checks, first failing reason wins
+        reasons = np.full(n, '', dtype=object)
+        checks = [
+            ((titles == '').to_numpy(), 'missing title'),
+            ((ids.str.strip() == '').to_numpy(), 'missing permanent_id'),
+            (~np.isfinite(prices), 'unparseable price'),
+            (prices < 0, 'negative price'),
+            (ids.duplicated().to_numpy() | ids.isin(seen_ids).to_numpy(), 'duplicate permanent_id'),
+        ]
+        for failed, reason in checks:
+            reasons[(reasons == '') & failed] = reason
+
+        for position in np.flatnonzero(reasons != ''):
+            self.rejects.append({
+                'line': int(lines[position]),
+                'permanent_id': ids.iat[position],
+                'title': titles.iat[position],
+                'reason': reasons[position],
+            })
+
+        keep = reasons == ''
+        tags = countries + ',' + brands + ',' + alcohol
+        kept = [
+            (values.to_numpy() if isinstance(values, pd.Series) else values)[keep].tolist()
+            for values in (ids, titles, column('description'), prices, categories, tags,
+                           column('image_url'), ratings, alcohol, countries, abv, rating_values)
+        ]
+        entries = []
+        for (product_id, name, description, price, category, tag_text, image,
+             rating, alcohol_content, country, abv_value, rating_value) in zip(*kept):
+            product = {
+                'id': product_id,
+                'name': name,
+                'description': description,
+                'price': price,
+                'category': category,
+                'tags': tag_text,
+                'image': image,
+                'rating': rating,
+                'alcohol_content': alcohol_content
+            }
+            metadata = {
+                'name': name,
+                'category': category,
+                'price': price,
+                'country': country,
+                'product_id': product_id,
+                'source': 'csv'
+            }
+            # Numbers are stored typed so range filters work; blanks are left
+            # out rather than stored as 0 so they never match one
+            if math.isfinite(abv_value):
+                metadata['alcohol_content'] = abv_value
+            if math.isfinite(rating_value):
+                metadata['rating'] = rating_value
+            metadata['content_hash'] = content_hash(product, metadata)
+            entries.append((product, metadata))
+
+        seen_ids.update(kept[0])
+        return entries
+
+    def write_rejects(self, path):
+        """Write the rows rejected by the last read as CSV; returns how many there were"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=REJECT_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rejects)
+        os.replace(tmp_path, path)
+        return len(self.rejects)
@@ -0,0 +1,185 @@
+# embedding_cache.py
+import os
+import json
+import hashlib
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+
+class EmbeddingCache:
+    """Content-addressed on-disk store of text embeddings.
+
+    Vectors are kept in a flat float32 file that is memory-mapped for reads,
+    with a parallel keys file holding one hash per row. Both files are only
+    ever appended to, so caching a new vector never rewrites existing data.
+    Appends take a file lock and first pick up rows other processes have
+    added, so several workers can share one cache directory.
+    """
+
+    def __init__(self, cache_dir, model_name):
+        self.model_name = model_name
+        self.cache_dir = os.path.join(cache_dir, model_name.replace('/', '__'))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.vectors_path = os.path.join(self.cache_dir, 'vectors.f32')
+        self.keys_path = os.path.join(self.cache_dir, 'keys.txt')
+        self.meta_path = os.path.join(self.cache_dir, 'meta.json')
+        self.lock_path = os.path.join(self.cache_dir, 'lock')
+
+        self.dim = None
+        self.index = {}
+        # Vector and key bytes appended by this process
+        self.bytes_written = 0
+        self._keys_offset = 0
+        self._vectors = None
+        with self._file_lock():
+            self._load()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, text):
+        return self.key(text) in self.index
+
+    def key(self, text):
+        """Hash a text together with the model name into a cache key"""
+        return hashlib.sha1(f"{self.model_name}\n{text}".encode('utf-8')).hexdigest()
+
+    def _load(self):
+        """Read the key index and drop any rows left half-written by a crash"""
+        try:
+            with open(self.meta_path, 'r') as f:
+                self.dim = json.load(f)['dim']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return
+
+        try:
+            with open(self.keys_path, 'r') as f:
+                # Only complete lines count; a trailing partial line is discarded
+                keys = f.read().split('\n')[:-1]
+        except FileNotFoundError:
+            keys = []
+
+        row_bytes = self.dim * 4
+        vector_rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+        count = min(len(keys), vector_rows)
+
+        # Trim both files back to the rows they agree on so appends stay aligned
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != count * row_bytes:
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(count * row_bytes)
+        if len(keys) != count:
+            with open(self.keys_path, 'w') as f:
+                f.writelines(f"{key}\n" for key in keys[:count])
+
+        self.index = {key: row for row, key in enumerate(keys[:count])}
+        self._keys_offset = sum(len(key) + 1 for key in keys[:count])
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Hold an exclusive lock on the cache directory across processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_new_keys(self):
+        """Index rows that other processes appended since we last looked"""
+        if self.dim is None:
+            self._load()
+            return
+        try:
+            with open(self.keys_path, 'r') as f:
+                f.seek(self._keys_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        new_keys = data.split('\n')[:-1]
+        for key in new_keys:
+            self.index.setdefault(key, len(self.index))
+        self._keys_offset += sum(len(key) + 1 for key in new_keys)
+        if new_keys:
+            self._vectors = None
+
+    def _matrix(self):
+        """Memory-map the vectors file, re-mapping lazily after appends"""
+        if self._vectors is None and self.index:
+            self._vectors = np.memmap(
+                self.vectors_path, dtype=np.float32, mode='r',
+                shape=(len(self.index), self.dim)
+            )
+        return self._vectors
+
+    def get(self, text):
+        """Return the cached vector for a text, or None on a miss"""
+        row = self.index.get(self.key(text))
+        if row is None:
+            return None
+        return np.array(self._matrix()[row])
+
+    def put_many(self, texts, vectors):
+        """Append vectors for texts that are not cached yet"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+        with self._file_lock():
+            self._read_new_keys()
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self.meta_path, 'w') as f:
+                    json.dump({'model_name': self.model_name, 'dim': self.dim}, f)
+
+            new_keys = {}
+            new_rows = []
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                if key in self.index or key in new_keys:
+                    continue
+                new_keys[key] = len(self.index) + len(new_rows)
+                new_rows.append(vector)
+
+            if not new_keys:
+                return 0
+
+            # Vectors are written before keys so a crash leaves at most an
+            # unreferenced tail, which _load trims on the next start
+            payload = np.ascontiguousarray(new_rows, dtype=np.float32).tobytes()
+            with open(self.vectors_path, 'ab') as f:
+                f.write(payload)
+            with open(self.keys_path, 'a') as f:
+                f.writelines(f"{key}\n" for key in new_keys)
+            self.bytes_written += len(payload) + sum(len(key) + 1 for key in new_keys)
+
+            self.index.update(new_keys)
+            self._keys_offset += sum(len(key) + 1 for key in new_keys)
+            self._vectors = None
+            return len(new_keys)
+
+    def encode(self, texts, encode_fn):
+        """Return an embedding matrix for texts, calling encode_fn only for misses"""
+        keys = [self.key(text) for text in texts]
+
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key not in self.index and key not in missing:
+                missing[key] = text
+
+        if missing:
+            missing_texts = list(missing.values())
+            self.put_many(missing_texts, encode_fn(missing_texts))
+
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+
+        matrix = self._matrix()
+        return np.array(matrix[[self.index[key] for key in keys]])
@@ -0,0 +1,167 @@
+# encoder_backends.py
+"""Sentence encoder backends: PyTorch through sentence-transformers, or an
+ONNX export of the same model run by onnxruntime.
+
+The ONNX backends are exported once from the PyTorch model (which needs torch
+and onnx) into onnx_dir; after that they load with only onnxruntime and
+tokenizers, so a warm start never imports torch.
+"""
+import os
+import json
+import numpy as np
+
+ENCODER_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+
+def load_encoder(model_name, backend='torch', onnx_dir='data/onnx'):
+    """Return an object with encode(texts, batch_size=32) for the given backend"""
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {backend}")
+
+    if backend == 'torch':
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+
+    export_dir = os.path.join(onnx_dir, model_name.replace('/', '__'))
+    quantize = backend == 'onnx-int8'
+    model_path = os.path.join(export_dir, 'model_int8.onnx' if quantize else 'model.onnx')
+    if not os.path.exists(model_path):
+        export_onnx(model_name, export_dir, quantize=quantize)
+    return OnnxEncoder(export_dir, model_path)
+
+
+def export_onnx(model_name, export_dir, quantize=False, opset=17):
+    """Export a sentence-transformers model's transformer to ONNX, with its tokenizer and pooling settings"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(export_dir, exist_ok=True)
+    model_path = os.path.join(export_dir, 'model.onnx')
+
+    if not os.path.exists(model_path):
+        st_model = SentenceTransformer(model_name, device='cpu')
+        transformer = st_model[0].auto_model.eval()
+        tokenizer = st_model.tokenizer
+        # Plain attention exports to a graph onnxruntime can fuse; the SDPA
+        # path traces into ops it cannot
+        if hasattr(transformer, 'set_attn_implementation'):
+            transformer.set_attn_implementation('eager')
+        else:
+            transformer.config._attn_implementation = 'eager'
+
+        # Pooling and normalization run in NumPy at inference time
+        pooling = st_model[1]
+        pooling_mode = pooling.get_pooling_mode_str() if hasattr(pooling, 'get_pooling_mode_str') else 'mean'
+        if pooling_mode not in ('mean', 'cls'):
+            raise ValueError(f"Unsupported pooling mode for ONNX export: {pooling_mode}")
+        settings = {
+            'model_name': model_name,
+            'pooling': pooling_mode,
+            'normalize': any(type(module).__name__ == 'Normalize' for module in st_model),
+            'max_seq_length': st_model.max_seq_length,
+            'dimension': st_model.get_sentence_embedding_dimension(),
+        }
+
+        sample = tokenizer(["An example wine description."], return_tensors='pt')
+        input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+        dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+
+        class LastHiddenState(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, *inputs):
+                return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+        tmp_path = f"{model_path}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                LastHiddenState(transformer),
+                tuple(sample[name] for name in input_names),
+                tmp_path,
+                input_names=input_names,
+                output_names=['last_hidden_state'],
+                dynamic_axes=dynamic_axes,
+                opset_version=opset,
+                dynamo=False
+            )
+        tokenizer.save_pretrained(export_dir)
+        with open(os.path.join(export_dir, 'encoder.json'), 'w') as f:
+            json.dump(settings, f, indent=2)
+        os.replace(tmp_path, model_path)
+        print(f"Exported {model_name} to {model_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = os.path.join(export_dir, 'model_int8.onnx')
+        quantize_dynamic(model_path, f"{quantized_path}.tmp", weight_type=QuantType.QInt8)
+        os.replace(f"{quantized_path}.tmp", quantized_path)
+        print(f"Quantized {model_path} to {quantized_path}")
+        return quantized_path
+    return model_path
+
+
+class OnnxEncoder:
+    """Runs an exported sentence encoder with onnxruntime, pooling in NumPy"""
+
+    def __init__(self, export_dir, model_path, threads=None):
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(export_dir, 'encoder.json')) as f:
+            self.settings = json.load(f)
+        self.model_path = model_path
+        self.tokenizer = Tokenizer.from_file(os.path.join(export_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(self.settings['max_seq_length'])
+        self.tokenizer.enable_padding()
+        self._open_session(threads)
+
+    def _open_session(self, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def after_fork(self, threads=1):
+        """Open a fresh session; the parent's thread pool did not survive the fork"""
+        self._open_session(threads)
+
+    def get_sentence_embedding_dimension(self):
+        return self.settings['dimension']
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+
+        # Batch texts of similar length together so little time goes on padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings = np.zeros((len(texts), self.settings['dimension']), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            embeddings[rows] = self._encode_batch([texts[i] for i in rows])
+        return embeddings[0] if single else embeddings
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+            'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+
+        if self.settings['pooling'] == 'cls':
+            embeddings = hidden[:, 0]
+        else:
+            mask = inputs['attention_mask'][:, :, None].astype(np.float32)
+            embeddings = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+        if self.settings['normalize']:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, 1e-12)
+        return embeddings.astype(np.float32)
@@ -0,0 +1,153 @@
+# feedback_store.py
+import os
+import json
+
+from append_log import AppendLog
+
+
+def apply_feedback_event(feedback, event):
+    """Apply one thumbs-up/down event to the feedback dict.
+
+    Returns (like_delta, dislike_delta): how the user's liked and disliked
+    sets changed, each -1, 0 or +1.
+    """
+    user_id = event['user_id']
+    product_id = event['product_id']
+
+    # Initialize user if not exists
+    if user_id not in feedback["users"]:
+        feedback["users"][user_id] = {
+            "likes": [],
+            "dislikes": [],
+            "timestamps": {}
+        }
+
+    user_data = feedback["users"][user_id]
+    was_liked = product_id in user_data["likes"]
+    was_disliked = product_id in user_data["dislikes"]
+
+    # Remove product from opposite list if it exists
+    if event['feedback'] == "up":
+        if was_disliked:
+            user_data["dislikes"].remove(product_id)
+        if not was_liked:
+            user_data["likes"].append(product_id)
+        deltas = (0 if was_liked else 1), (-1 if was_disliked else 0)
+    else:  # event['feedback'] == "down"
+        if was_liked:
+            user_data["likes"].remove(product_id)
+        if not was_disliked:
+            user_data["dislikes"].append(product_id)
+        deltas = (-1 if was_liked else 0), (0 if was_disliked else 1)
+
+    # Add timestamp
+    user_data["timestamps"][product_id] = event['timestamp']
+    return deltas
+
+
+class FeedbackStore:
+    """Feedback persistence as a JSON snapshot plus an append-only event log.
+
+    Each click costs one small append to the log. load() reads the snapshot
+    and replays the log over it; compact() folds everything back into a new
+    snapshot and starts a new, empty log.
+
+    Several processes may append to the same log and pick up each other's
+    events with read_new_events(). Any of them may compact, under the log's
+    exclusive lock (see AppendLog) and once it has applied every event so
+    far; the others finish the old log and carry on with the new one.
+    Events carry the PID of the process that logged them, so a process
+    does not read back its own.
+    """
+
+    def __init__(self, snapshot_path, log_path=None, compact_every=1000):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path or os.path.splitext(snapshot_path)[0] + '.log.jsonl'
+        self.compact_every = compact_every
+        self.log = AppendLog(self.log_path)
+        # Events in the log that the snapshot does not cover yet
+        self.pending_events = 0
+        # Log appends and snapshots written by this process
+        self.bytes_written = 0
+        # Processes whose events are already applied in this one's memory:
+        # itself and, after a fork, the master it was forked from
+        self._own_pids = {os.getpid()}
+
+    def load(self):
+        """Read the snapshot and replay any logged events on top of it"""
+        # Under the lock, so the snapshot and the log match
+        with self.log.locked():
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    feedback = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                feedback = {"users": {}}
+            self.log.reset()
+            events = self.log.read_new()
+
+        self.pending_events = len(events)
+        for event in events:
+            apply_feedback_event(feedback, event)
+
+        return feedback
+
+    def read_new_events(self):
+        """Return complete events appended to the log since the last read.
+
+        Returns None if the log was compacted more than once meanwhile;
+        load() then gives the feedback as it stands.
+        """
+        replacements = self.log.replacements
+        events = self.log.read_new()
+        if events is not None:
+            if self.log.replacements != replacements:
+                # Another process compacted
+                self.pending_events = 0
+            # This process's own events were applied and counted by append()
+            events = self._from_others(events)
+            self.pending_events += len(events)
+        return events
+
+    def _from_others(self, events):
+        return [event for event in events if event.get('pid') not in self._own_pids]
+
+    def append(self, event):
+        """Append one event to the log and return the bytes written"""
+        size = self.log.append({**event, 'pid': os.getpid()})
+        self.pending_events += 1
+        self.bytes_written += size
+        return size
+
+    def needs_compaction(self):
+        return self.compact_every is not None and self.pending_events >= self.compact_every
+
+    def exclusive(self):
+        """Keep other processes from appending or compacting; hold it to read the last events before compact()"""
+        return self.log.locked(exclusive=True)
+
+    def compact(self, feedback):
+        """Write feedback as the new snapshot and start a new event log; returns the snapshot's size"""
+        with self.exclusive():
+            # Nothing logged so far may be carried over into the new log:
+            # this process's events are in feedback already, and other
+            # processes' are applied now
+            for event in self._from_others(self.log.read_new() or ()):
+                apply_feedback_event(feedback, event)
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(feedback, f, indent=2)
+                size = f.tell()
+            os.replace(tmp_path, self.snapshot_path)
+            self.bytes_written += size
+
+            # The snapshot now includes every logged event
+            self.log.replace()
+        self.pending_events = 0
+        return size
+
+    def after_fork(self):
+        self._own_pids.add(os.getpid())
+        self.log.after_fork()
+
+    def close(self):
+        self.log.close()
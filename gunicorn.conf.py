@@ -0,0 +1,23 @@
+# gunicorn.conf.py
+import gc
+import os
+
+# Build the engine once in the master (see ENGINE_MODE in app.py) so every
+# worker shares the model weights and catalogue matrix copy-on-write. The
+# neighbour graph is built offline with build_neighbours.py
+os.environ.setdefault('ENGINE_MODE', 'shared')
+preload_app = True
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 2))
+
+
+def pre_fork(server, worker):
+    # Keep the garbage collector from touching (and so un-sharing) the
+    # master's objects in every worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import engine
+    engine.after_fork()
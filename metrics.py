@@ -0,0 +1,184 @@
+# metrics.py
+import os
+import time
+import bisect
+import random
+import threading
+import contextlib
+
+# Seconds, from a cached page turn to a cold model load
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+RATIO_BUCKETS = (1, 1.5, 2, 3, 5, 10, 20, 50, 100)
+
+_NOOP_SPAN = contextlib.nullcontext()
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in (labels[key] for key in sorted(labels)))
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(sorted(labels), escaped)) + '}'
+
+
+def _number_text(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Span:
+    __slots__ = ('metrics', 'labels', 'start')
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics:
+    """Process-local counters and histograms, rendered in the Prometheus text format.
+
+    Hot paths call inc(), observe() and span(); when the registry is
+    disabled these return straight away (span() hands back a shared no-op
+    context manager), so instrumentation costs a method call. Figures the
+    engine already keeps, such as cache and encoder counters, are read by
+    collectors only when the metrics are rendered.
+
+    Each process has its own registry: under Gunicorn a scrape sees the
+    worker that served it.
+    """
+
+    def __init__(self, enabled=True, prefix='recommender'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter; names should end in _total"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Record a value in a histogram; the buckets are fixed by the first observation"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                                     'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(histogram['buckets'], value)
+            if index < len(histogram['counts']):
+                histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def span(self, stage, **labels):
+        """Context manager timing a stage into the stage_seconds histogram"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, {'stage': stage, **labels})
+
+    def add_collector(self, collect):
+        """Register collect() -> iterable of (name, kind, value, labels), called at render time"""
+        self._collectors.append(collect)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        families = {}
+
+        def sample(name, kind, suffix, labels, value):
+            family = families.setdefault(f"{self.prefix}_{name}", {'kind': kind, 'samples': []})
+            family['samples'].append((suffix, labels, value))
+
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                sample(name, 'counter', '', dict(labels), value)
+            for (name, labels), histogram in self._histograms.items():
+                labels = dict(labels)
+                cumulative = 0
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    cumulative += count
+                    sample(name, 'histogram', '_bucket', {**labels, 'le': _number_text(float(bound))}, cumulative)
+                sample(name, 'histogram', '_bucket', {**labels, 'le': '+Inf'}, histogram['count'])
+                sample(name, 'histogram', '_sum', labels, histogram['sum'])
+                sample(name, 'histogram', '_count', labels, histogram['count'])
+
+        for collect in self._collectors:
+            for name, kind, value, labels in collect():
+                if value is not None:
+                    sample(name, kind, '', labels or {}, value)
+
+        lines = []
+        for name in sorted(families):
+            lines.append(f"# TYPE {name} {families[name]['kind']}")
+            for suffix, labels, value in families[name]['samples']:
+                lines.append(f"{name}{suffix}{_label_text(labels)} {_number_text(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class SlowRequestProfiler:
+    """Runs cProfile on a random sample of requests and keeps the slow ones.
+
+    A sampled request whose handling takes longer than slow_seconds has its
+    profile written to out_dir as a .prof file (open it with pstats or
+    snakeviz); only the newest keep files are kept. sample_rate=0 turns it
+    off without any per-request cost beyond a comparison.
+    """
+
+    def __init__(self, sample_rate=0.0, slow_seconds=0.5, out_dir='data/profiles', keep=50):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.out_dir = out_dir
+        self.keep = keep
+        self.captured = 0
+
+    def start(self):
+        """Return a running profiler for a sampled request, or None"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        import cProfile
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process
+            return None
+        return profile
+
+    def finish(self, profile, elapsed, name):
+        """Stop a profiler from start(); returns the path written, if the request was slow"""
+        if profile is None:
+            return None
+        profile.disable()
+        if elapsed < self.slow_seconds:
+            return None
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        safe_name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)
+        path = os.path.join(self.out_dir, f"{time.time_ns()}-{safe_name}-{elapsed * 1000:.0f}ms.prof")
+        profile.dump_stats(path)
+        self.captured += 1
+
+        profiles = sorted(entry for entry in os.listdir(self.out_dir) if entry.endswith('.prof'))
+        for stale in profiles[:-self.keep]:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.out_dir, stale))
+        return path
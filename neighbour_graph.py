@@ -0,0 +1,190 @@
+# neighbour_graph.py
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def catalogue_fingerprint(ids, embeddings):
+    """Hash of the product IDs, in row order, and the matrix a graph was built from"""
+    digest = hashlib.sha1('\n'.join(ids).encode('utf-8'))
+    digest.update(np.ascontiguousarray(embeddings, dtype=np.float32))
+    return digest.hexdigest()
+
+
+def _inverse_norms(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1)
+    return np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+
+
+class NeighbourGraph:
+    """The k most similar products of every catalogue row, by cosine similarity.
+
+    Rows line up with the ProductStore rows: ids[row] holds the neighbours'
+    row numbers as int32, best first, and scores[row] their similarities as
+    float32; lists shorter than k are padded with -1 and -inf. Looking up a
+    product's neighbours is then a slice, with no vector query.
+
+    build() scores the catalogue against itself in blocks, which is
+    quadratic in its size. After that, insert() and remove() keep the lists
+    exact for single edits by scoring just the rows concerned, mirroring the
+    store's move-last-into-the-gap deletes. save() writes both arrays next
+    to a fingerprint of the catalogue, and load() maps them back
+    copy-on-write, so forked workers share the pages until they edit them.
+    Owners that save in batches save a copy(), which later edits leave alone.
+    """
+
+    def __init__(self, k, ids, scores):
+        self.k = k
+        self.ids = ids
+        self.scores = scores
+        self.rows = len(ids)
+        # The ProductStore version the lists match; set by the owner
+        self.version = None
+
+    def __len__(self):
+        return self.rows
+
+    @classmethod
+    def build(cls, embeddings, k=20, block_bytes=64 << 20):
+        """Compute every row's top-k list, scoring blocks of rows against the whole matrix"""
+        rows = len(embeddings)
+        graph = cls(k, np.full((rows, k), -1, dtype=np.int32), np.full((rows, k), -np.inf, dtype=np.float32))
+        inverse_norms = _inverse_norms(embeddings)
+        block_rows = max(1, block_bytes // (4 * max(rows, 1)))
+        for start in range(0, rows, block_rows):
+            graph._fill(np.arange(start, min(rows, start + block_rows)), embeddings, inverse_norms)
+        return graph
+
+    def neighbours(self, row):
+        """Neighbour rows and scores of one row, best first"""
+        ids = np.asarray(self.ids[row])
+        valid = ids >= 0
+        return ids[valid], np.asarray(self.scores[row])[valid]
+
+    def _similarities(self, rows, embeddings, inverse_norms):
+        """Cosine similarity of some rows against every row, with each row's own score masked"""
+        similarities = (embeddings[rows] @ embeddings.T) * inverse_norms[rows, None] * inverse_norms
+        similarities[np.arange(len(rows)), rows] = -np.inf
+        return similarities
+
+    def _fill(self, rows, embeddings, inverse_norms):
+        """Recompute the lists of the given rows from scratch"""
+        if not len(rows):
+            return
+        similarities = self._similarities(rows, embeddings, inverse_norms)
+        k = min(self.k, self.rows - 1)
+        self.ids[rows] = -1
+        self.scores[rows] = -np.inf
+        if k <= 0:
+            return
+        candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(similarities, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')[:, :k]
+        self.ids[rows, :k] = np.take_along_axis(candidates, order, axis=1)
+        self.scores[rows, :k] = np.take_along_axis(candidate_scores, order, axis=1)
+
+    def _resize(self, rows):
+        """Make room for rows lists; a mapped graph is copied into memory when it grows"""
+        if rows > len(self.ids):
+            capacity = max(rows, 2 * len(self.ids), 16)
+            ids = np.full((capacity, self.k), -1, dtype=np.int32)
+            scores = np.full((capacity, self.k), -np.inf, dtype=np.float32)
+            ids[:self.rows] = self.ids[:self.rows]
+            scores[:self.rows] = self.scores[:self.rows]
+            self.ids, self.scores = ids, scores
+        self.rows = rows
+
+    def insert(self, row, embeddings):
+        """Bring the graph up to date after the embedding of row was added or replaced"""
+        if row > self.rows:
+            raise ValueError(f"Row {row} is past the end of a graph of {self.rows} rows")
+        self._resize(max(self.rows, row + 1))
+        inverse_norms = _inverse_norms(embeddings[:self.rows])
+        embeddings = embeddings[:self.rows]
+
+        # Lists holding the old version of a replaced row have a stale score
+        stale = np.flatnonzero((self.ids[:self.rows] == row).any(axis=1))
+        self._fill(np.union1d(stale, [row]), embeddings, inverse_norms)
+
+        # Similarity is symmetric: row joins every other list it now beats
+        # the last entry of
+        similarities = self._similarities(np.array([row]), embeddings, inverse_norms)[0]
+        beaten = np.flatnonzero(similarities > self.scores[:self.rows, -1])
+        for other in np.setdiff1d(beaten, stale):
+            position = np.searchsorted(-self.scores[other], -similarities[other], side='right')
+            self.ids[other, position + 1:] = self.ids[other, position:-1].copy()
+            self.scores[other, position + 1:] = self.scores[other, position:-1].copy()
+            self.ids[other, position] = row
+            self.scores[other, position] = similarities[other]
+
+    def remove(self, row, embeddings):
+        """Drop row the way ProductStore.remove does: the last row moves into its place.
+
+        embeddings is the matrix after the removal, one row shorter.
+        """
+        if row >= self.rows:
+            return
+        last = self.rows - 1
+        ids = self.ids[:self.rows]
+
+        # Lists that lost a neighbour are recomputed once the rows have moved
+        affected = np.flatnonzero((ids == row).any(axis=1))
+        ids[ids == row] = -1
+        if row != last:
+            ids[ids == last] = row
+            ids[row] = ids[last]
+            self.scores[row] = self.scores[last]
+            affected[affected == last] = row
+        self.ids[last] = -1
+        self.scores[last] = -np.inf
+        self.rows = last
+
+        affected = np.unique(affected[affected < self.rows])
+        if len(affected):
+            embeddings = embeddings[:self.rows]
+            self._fill(affected, embeddings, _inverse_norms(embeddings))
+
+    def copy(self):
+        """An in-memory copy of the lists"""
+        graph = NeighbourGraph(self.k, np.array(self.ids[:self.rows]), np.array(self.scores[:self.rows]))
+        graph.version = self.version
+        return graph
+
+    def save(self, path, fingerprint):
+        """Write the lists to path.i32 and path.f32, then the metadata to path.json; returns the bytes written"""
+        written = 0
+        for suffix, array in (('.i32', self.ids), ('.f32', self.scores)):
+            tmp_path = f"{path}{suffix}.tmp"
+            array = np.ascontiguousarray(array[:self.rows])
+            array.tofile(tmp_path)
+            os.replace(tmp_path, f"{path}{suffix}")
+            written += array.nbytes
+
+        # The metadata goes last, so it only ever describes complete arrays
+        tmp_path = f"{path}.json.tmp"
+        with open(tmp_path, 'w') as f:
+            written += f.write(json.dumps({'k': self.k, 'rows': self.rows, 'fingerprint': fingerprint}))
+        os.replace(tmp_path, f"{path}.json")
+        return written
+
+    @classmethod
+    def load(cls, path, fingerprint, k):
+        """Map a saved graph, or return None if it is missing or was built for another catalogue"""
+        try:
+            with open(f"{path}.json", 'r') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if meta.get('fingerprint') != fingerprint or meta.get('k') != k:
+            return None
+
+        shape = (meta['rows'], k)
+        if not meta['rows']:
+            return cls(k, np.full(shape, -1, dtype=np.int32), np.full(shape, -np.inf, dtype=np.float32))
+        try:
+            ids = np.memmap(f"{path}.i32", dtype=np.int32, mode='c', shape=shape)
+            scores = np.memmap(f"{path}.f32", dtype=np.float32, mode='c', shape=shape)
+        except (FileNotFoundError, ValueError):
+            return None
+        return cls(k, ids, scores)
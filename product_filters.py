@@ -0,0 +1,187 @@
+# product_filters.py
+import numpy as np
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _country(product):
+    # CSV products carry the country as the first of their comma-separated tags
+    if product.get('country'):
+        return product['country']
+    tags = product.get('tags') or ''
+    return tags.split(',')[0].strip()
+
+
+# Filterable fields: name -> (kind, value getter)
+FILTER_FIELDS = {
+    'price': ('numeric', lambda p: _number(p.get('price'))),
+    'alcohol_content': ('numeric', lambda p: _number(p.get('alcohol_content'))),
+    'rating': ('numeric', lambda p: _number(p.get('rating'))),
+    'category': ('categorical', lambda p: p.get('category') or ''),
+    'country': ('categorical', _country),
+}
+
+COMPARISONS = {'$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin'}
+
+
+def filter_metadata(product):
+    """The filterable fields of a product as Chroma metadata, valued as ColumnIndex sees them.
+
+    Numbers are stored typed so range filters work; blanks are left out
+    rather than stored as 0 so they never match one.
+    """
+    metadata = {}
+    for name, (kind, get_value) in FILTER_FIELDS.items():
+        value = get_value(product)
+        if kind == 'categorical' or np.isfinite(value):
+            metadata[name] = value
+    return metadata
+
+
+class ColumnIndex:
+    """Typed columns of the filterable product fields, aligned with ProductStore rows.
+
+    Numeric fields are float64 arrays with NaN for missing values, so no
+    comparison matches them; categorical fields are int32 codes into a
+    per-field vocabulary, so equality and membership tests are integer
+    compares over one array.
+    """
+
+    def __init__(self):
+        self._size = 0
+        self._capacity = 0
+        self.vocab = {name: {} for name, (kind, _) in FILTER_FIELDS.items() if kind == 'categorical'}
+        self.columns = {
+            name: np.zeros(0, dtype=np.float64 if kind == 'numeric' else np.int32)
+            for name, (kind, _) in FILTER_FIELDS.items()
+        }
+
+    def __len__(self):
+        return self._size
+
+    def column(self, name):
+        return self.columns[name][:self._size]
+
+    def code(self, name, value):
+        """Vocabulary code of a categorical value, or -1 if no product has it"""
+        return self.vocab[name].get(value, -1)
+
+    def set_row(self, row, product):
+        if row >= self._capacity:
+            self._capacity = max(16, row + 1, 2 * self._capacity)
+            for name, column in self.columns.items():
+                grown = np.zeros(self._capacity, dtype=column.dtype)
+                grown[:len(column)] = column
+                self.columns[name] = grown
+        self._size = max(self._size, row + 1)
+
+        for name, (kind, get_value) in FILTER_FIELDS.items():
+            value = get_value(product)
+            if kind == 'categorical':
+                value = self.vocab[name].setdefault(value, len(self.vocab[name]))
+            self.columns[name][row] = value
+
+    def move_row(self, source, target):
+        for column in self.columns.values():
+            column[target] = column[source]
+
+    def truncate(self, size):
+        self._size = size
+
+    def mask(self, where):
+        """Boolean row mask for a Chroma-style where clause"""
+        validate_where(where)
+        return self._mask(where)
+
+    def _mask(self, where):
+        mask = np.ones(self._size, dtype=bool)
+        for key, condition in where.items():
+            if key == '$and':
+                for clause in condition:
+                    mask &= self._mask(clause)
+            elif key == '$or':
+                any_clause = np.zeros(self._size, dtype=bool)
+                for clause in condition:
+                    any_clause |= self._mask(clause)
+                mask &= any_clause
+            else:
+                if not isinstance(condition, dict):
+                    condition = {'$eq': condition}
+                for op, value in condition.items():
+                    mask &= self._compare(key, op, value)
+        return mask
+
+    def _compare(self, name, op, value):
+        column = self.column(name)
+        if FILTER_FIELDS[name][0] == 'categorical':
+            if op in ('$in', '$nin'):
+                codes = [self.code(name, v) for v in value]
+                matched = np.isin(column, codes)
+                return matched if op == '$in' else ~matched
+            if op in ('$eq', '$ne'):
+                matched = column == self.code(name, value)
+                return matched if op == '$eq' else ~matched
+            raise ValueError(f"{op} is not supported on categorical field {name}")
+
+        if op in ('$in', '$nin'):
+            matched = np.isin(column, [float(v) for v in value])
+            return matched if op == '$in' else ~matched & ~np.isnan(column)
+        value = float(value)
+        if op == '$eq':
+            return column == value
+        if op == '$ne':
+            return (column != value) & ~np.isnan(column)
+        if op == '$gt':
+            return column > value
+        if op == '$gte':
+            return column >= value
+        if op == '$lt':
+            return column < value
+        return column <= value
+
+
+def validate_where(where):
+    """Raise ValueError unless where is a filter this module can evaluate"""
+    if not isinstance(where, dict):
+        raise ValueError("Filters must be a dict")
+    for key, condition in where.items():
+        if key in ('$and', '$or'):
+            if not isinstance(condition, list):
+                raise ValueError(f"{key} takes a list of filters")
+            for clause in condition:
+                validate_where(clause)
+            continue
+        if key not in FILTER_FIELDS:
+            raise ValueError(f"Cannot filter on {key}; filterable fields are {', '.join(FILTER_FIELDS)}")
+        if isinstance(condition, dict):
+            for op, value in condition.items():
+                if op not in COMPARISONS:
+                    raise ValueError(f"Unknown filter operator: {op}")
+                if op in ('$in', '$nin') and not isinstance(value, (list, tuple, set)):
+                    raise ValueError(f"{op} takes a list of values")
+
+
+def chroma_where(where):
+    """Rewrite a validated where clause in the form Chroma accepts.
+
+    Chroma wants exactly one field or operator per dict, so a clause over
+    several fields, or with several operators on one field (a price range,
+    say), becomes an $and of single-operator clauses.
+    """
+    clauses = []
+    for key, condition in where.items():
+        if key in ('$and', '$or'):
+            nested = [chroma_where(clause) for clause in condition]
+            # $and and $or take at least two clauses
+            clauses.append(nested[0] if len(nested) == 1 else {key: nested})
+        elif isinstance(condition, dict):
+            clauses.extend({key: {op: list(value) if op in ('$in', '$nin') else value}}
+                           for op, value in condition.items())
+        else:
+            clauses.append({key: condition})
+    return clauses[0] if len(clauses) == 1 else {'$and': clauses}
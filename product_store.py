@@ -0,0 +1,226 @@
+# product_store.py
+import os
+import random
+import numpy as np
+
+from product_filters import ColumnIndex
+
+
+class ProductStore:
+    """In-memory product table with an id index and an aligned embedding matrix.
+
+    Rows are kept densely packed: deleting a product moves the last row into
+    its slot, so removal is O(1) and the embedding matrix never has holes.
+    Row order therefore follows insertion order only until the first delete.
+    The filterable fields are mirrored into typed columns (see ColumnIndex)
+    that stay aligned with the rows.
+
+    Every mutation bumps `version` and is journalled as ('set', row) or
+    ('remove', row, last), so data derived from the rows can be patched with
+    changes_since() instead of being rebuilt after each edit.
+    """
+
+    # Journal entries kept; derived data older than those is rebuilt in full
+    max_changes = 4096
+
+    def __init__(self, products=None):
+        self.reset(products)
+
+    def reset(self, products=None):
+        """Replace the whole catalogue; embeddings have to be filled in again"""
+        products = list(products or [])
+        index = {}
+        for product in products:
+            index.setdefault(product['id'], len(index))
+        if len(index) != len(products):
+            # Keep the last copy of any repeated ID, at its first position
+            latest = {product['id']: product for product in products}
+            products = [latest[product_id] for product_id in index]
+
+        columns = ColumnIndex()
+        for row, product in enumerate(products):
+            columns.set_row(row, product)
+
+        # Swap the new table in with as few steps as possible, since readers
+        # on other threads may be iterating the old one
+        self._embeddings = None
+        self._has_embedding = np.zeros(0, dtype=bool)
+        self._products, self._index, self.columns = products, index, columns
+        # Bumped on every mutation so derived data can tell it is stale
+        self.version = getattr(self, 'version', 0) + 1
+        self._changes = []
+        self._changes_base = self.version
+
+    def _record(self, *change):
+        """Bump the version and journal the change that made it"""
+        self.version += 1
+        self._changes.append((self.version,) + change)
+        if len(self._changes) > self.max_changes:
+            del self._changes[:len(self._changes) // 2]
+            self._changes_base = self._changes[0][0] - 1
+
+    def changes_since(self, version):
+        """Row changes made after version, oldest first, or None if they are no longer all known"""
+        if version is None or version < self._changes_base:
+            return None
+        return [change[1:] for change in self._changes if change[0] > version]
+
+    def __len__(self):
+        return len(self._products)
+
+    def __iter__(self):
+        return iter(self._products)
+
+    def __contains__(self, product_id):
+        return product_id in self._index
+
+    def __getitem__(self, row):
+        return self._products[row]
+
+    def get(self, product_id):
+        """Return the product with the given ID, or None"""
+        row = self._index.get(product_id)
+        return None if row is None else self._products[row]
+
+    def row(self, product_id):
+        """Return the matrix row holding a product, or None"""
+        return self._index.get(product_id)
+
+    def ids(self):
+        return [product['id'] for product in self._products]
+
+    def to_list(self):
+        return list(self._products)
+
+    @property
+    def embeddings(self):
+        """Embedding matrix with one row per product, in row order"""
+        if self._embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._embeddings[:len(self._products)]
+
+    def _ensure_capacity(self, rows, dim):
+        if self._embeddings is None:
+            self._embeddings = np.zeros((max(rows, 16), dim), dtype=np.float32)
+        elif rows > len(self._embeddings):
+            grown = np.zeros((max(rows, 2 * len(self._embeddings)), dim), dtype=np.float32)
+            grown[:len(self._embeddings)] = self._embeddings
+            self._embeddings = grown
+
+        if len(self._embeddings) > len(self._has_embedding):
+            grown = np.zeros(len(self._embeddings), dtype=bool)
+            grown[:len(self._has_embedding)] = self._has_embedding
+            self._has_embedding = grown
+
+    def add(self, product, embedding=None):
+        """Insert a product, replacing any existing product with the same ID"""
+        row = self._index.get(product['id'])
+        if row is None:
+            row = len(self._products)
+            self._products.append(product)
+            self._index[product['id']] = row
+            if self._embeddings is not None:
+                self._ensure_capacity(row + 1, self._embeddings.shape[1])
+                self._has_embedding[row] = False
+        else:
+            self._products[row] = product
+            if row < len(self._has_embedding):
+                self._has_embedding[row] = False
+        self.columns.set_row(row, product)
+
+        self._record('set', row)
+        if embedding is not None:
+            self.set_embedding(product['id'], embedding)
+        return product
+
+    def remove(self, product_id):
+        """Delete a product in O(1) by moving the last row into its slot"""
+        row = self._index.pop(product_id, None)
+        if row is None:
+            return None
+
+        removed = self._products[row]
+        last = len(self._products) - 1
+        if row != last:
+            moved = self._products[last]
+            self._products[row] = moved
+            self._index[moved['id']] = row
+            if self._embeddings is not None:
+                self._embeddings[row] = self._embeddings[last]
+                self._has_embedding[row] = self._has_embedding[last]
+            self.columns.move_row(last, row)
+        self._products.pop()
+        self.columns.truncate(last)
+        if self._embeddings is not None:
+            self._has_embedding[last] = False
+        self._record('remove', row, last)
+        return removed
+
+    def map_embeddings(self, path):
+        """Move the embedding matrix into a file-backed, copy-on-write memory map.
+
+        Processes forked after this share the matrix through the page cache;
+        a process that edits a row only copies the pages it touches.
+        """
+        embeddings = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        tmp_path = f"{path}.tmp"
+        embeddings.tofile(tmp_path)
+        os.replace(tmp_path, path)
+
+        if len(embeddings):
+            self._embeddings = np.memmap(path, dtype=np.float32, mode='c', shape=embeddings.shape)
+        return path
+
+    def set_embedding(self, product_id, embedding):
+        row = self._index[product_id]
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._ensure_capacity(len(self._products), embedding.shape[-1])
+        self._embeddings[row] = embedding
+        self._has_embedding[row] = True
+        self._record('set', row)
+
+    def embedding(self, product_id):
+        """Return a product's embedding, or None if it is unknown or not embedded yet"""
+        row = self._index.get(product_id)
+        if row is None or row >= len(self._has_embedding) or not self._has_embedding[row]:
+            return None
+        return self._embeddings[row]
+
+    def missing_embeddings(self):
+        """Products that have no embedding row filled in yet"""
+        if self._embeddings is None:
+            return list(self._products)
+        has_embedding = self._has_embedding[:len(self._products)]
+        return [self._products[row] for row in np.flatnonzero(~has_embedding)]
+
+    def filter_rows(self, where):
+        """Row numbers of the products matching a Chroma-style where clause"""
+        return np.flatnonzero(self.columns.mask(where))
+
+    def sample(self, n, exclude=None, rows=None):
+        """Pick up to n random products whose IDs are not in the exclude set.
+
+        rows, if given, restricts the draw to those rows (e.g. filter_rows output).
+        """
+        exclude = exclude or set()
+        if rows is not None:
+            pool = [self._products[row] for row in rows if self._products[row]['id'] not in exclude]
+            return random.sample(pool, min(n, len(pool)))
+
+        excluded_rows = sum(1 for product_id in exclude if product_id in self._index)
+        available = len(self._products) - excluded_rows
+
+        if available <= n:
+            return [p for p in self._products if p['id'] not in exclude]
+
+        if excluded_rows * 2 > len(self._products):
+            # Mostly excluded: filtering once is cheaper than rejecting draws
+            return random.sample([p for p in self._products if p['id'] not in exclude], n)
+
+        # Mostly available: rejection-sample rows without touching the rest
+        picked = {}
+        while len(picked) < n:
+            row = random.randrange(len(self._products))
+            if row not in picked and self._products[row]['id'] not in exclude:
+                picked[row] = self._products[row]
+        return list(picked.values())
@@ -0,0 +1,105 @@
+# quantization.py
+import numpy as np
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+
+def quantize_embeddings(embeddings, precision):
+    """Compress L2-normalized copies of the rows of an embedding matrix.
+
+    Returns (codes, scales). float16 keeps the unit vectors as half floats
+    and scales is None; int8 stores each row as round(v / s) with its own
+    scale s = max|v| / 127, so a row dequantizes as codes * s.
+    """
+    if precision not in PRECISIONS[1:]:
+        raise ValueError(f"Unknown embedding precision: {precision}")
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    unit = embeddings / np.where(norms > 0, norms, 1.0)
+
+    if precision == 'float16':
+        return unit.astype(np.float16), None
+
+    scales = np.abs(unit).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(unit / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedMatrix:
+    """A compressed catalogue matrix that scores unit-length queries.
+
+    NumPy has no BLAS kernels for int8 or float16, so scoring dequantizes
+    chunk_rows rows at a time and multiplies them in float32. Memory stays
+    at the compressed size plus one cache-sized chunk. Widening int8 is cheap
+    enough that the scan keeps pace with float32 while reading a quarter of
+    the bytes; float16 conversion is slow in NumPy, so that precision only
+    buys memory.
+
+    set_rows() and move_row() patch single rows after catalogue edits, so
+    only the pages of those rows are written (and, in a forked worker,
+    copied).
+    """
+
+    def __init__(self, codes, scales=None, chunk_rows=2048):
+        self.codes = codes
+        self.scales = scales
+        self.chunk_rows = chunk_rows
+        self.precision = 'int8' if scales is not None else 'float16'
+        # Arrays with room to grow; codes and scales are views of their first rows
+        self._code_buffer = codes
+        self._scale_buffer = scales
+
+    @classmethod
+    def from_embeddings(cls, embeddings, precision, chunk_rows=2048):
+        codes, scales = quantize_embeddings(embeddings, precision)
+        return cls(codes, scales, chunk_rows)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def resize(self, rows):
+        """Grow or shrink to rows rows; new rows are zero until set_rows() fills them"""
+        if rows > len(self._code_buffer):
+            capacity = max(rows, 2 * len(self._code_buffer), 16)
+            codes = np.zeros((capacity,) + self.codes.shape[1:], dtype=self.codes.dtype)
+            codes[:len(self.codes)] = self.codes
+            self._code_buffer = codes
+            if self.scales is not None:
+                scales = np.ones(capacity, dtype=np.float32)
+                scales[:len(self.scales)] = self.scales
+                self._scale_buffer = scales
+        self.codes = self._code_buffer[:rows]
+        if self.scales is not None:
+            self.scales = self._scale_buffer[:rows]
+
+    def set_rows(self, rows, embeddings):
+        """Re-quantize the given rows from their full-precision embeddings"""
+        codes, scales = quantize_embeddings(embeddings, self.precision)
+        self.codes[rows] = codes
+        if self.scales is not None:
+            self.scales[rows] = scales
+
+    def move_row(self, source, target):
+        self.codes[target] = self.codes[source]
+        if self.scales is not None:
+            self.scales[target] = self.scales[source]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def scores(self, unit_queries, rows=None):
+        """Approximate cosine similarity of each query against every row (or just rows)"""
+        unit_queries = np.atleast_2d(np.asarray(unit_queries, dtype=np.float32))
+        n_rows = len(self.codes) if rows is None else len(rows)
+        scores = np.empty((len(unit_queries), n_rows), dtype=np.float32)
+        for start in range(0, n_rows, self.chunk_rows):
+            stop = start + self.chunk_rows
+            chunk = slice(start, stop) if rows is None else rows[start:stop]
+            block = self.codes[chunk].astype(np.float32)
+            np.matmul(unit_queries, block.T, out=scores[:, start:stop])
+            if self.scales is not None:
+                scores[:, start:stop] *= self.scales[chunk]
+        return scores
@@ -0,0 +1,89 @@
+# recommendation_cache.py
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class RecommendationCache:
+    """Bounded LRU cache of ranked candidate IDs per user, with a TTL.
+
+    Each entry holds a user's top candidates from one vector search; later
+    pages are served from it by skipping IDs the user has already seen, until
+    the list runs dry, the entry expires, or it is invalidated.
+    """
+
+    def __init__(self, max_users=10000, ttl=300.0, depth=50):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.depth = depth
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Bumped on every invalidation, so a search that started before one
+        # cannot put its (possibly stale) ranking back afterwards
+        self.epoch = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.max_users > 0
+
+    def get(self, user_id):
+        """Return the cached ranked IDs for a user, or None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            ranked_ids, expires_at = entry
+            if self.ttl and time.monotonic() > expires_at:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return ranked_ids
+
+    def put(self, user_id, ranked_ids, epoch=None):
+        """Cache a ranking, unless anything was invalidated since epoch was read"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self._entries[user_id] = (list(ranked_ids), time.monotonic() + (self.ttl or 0))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self.epoch += 1
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.epoch += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
@@ -1,18 +1,39 @@
 # recommendation_engine.py
 import os
+import sys
 import json
-import chromadb
 import numpy as np
 import uuid
-import csv
-import os
+import time
+import atexit
+import threading
 
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
+from collections import OrderedDict
 from datetime import datetime
+from batching_encoder import BatchingEncoder
+from csv_ingest import CatalogueReader
+from embedding_cache import EmbeddingCache
+from encoder_backends import load_encoder
+from feedback_store import FeedbackStore, apply_feedback_event
+from metrics import RATIO_BUCKETS, SIZE_BUCKETS, Metrics
+from neighbour_graph import NeighbourGraph, catalogue_fingerprint
+from product_filters import filter_metadata, validate_where
+from product_store import ProductStore
+from recommendation_cache import RecommendationCache
+from text_index import BM25Index, reciprocal_rank_fusion
+from vector_backends import ChromaBackend, NumpyBackend
+from viewed_history import ViewedHistory
+from write_behind import WriteBehindSnapshot
 
 class ProductRecommendationEngine:
-    def __init__(self, db_path="chroma_db", products_path="data/products.json", feedback_path="data/feedback.json"):
+    def __init__(self, db_path="chroma_db", products_path="data/products.json", feedback_path="data/feedback.json",
+                 cache_dir="data/embedding_cache", model_name='sentence-transformers/all-MiniLM-L6-v2',
+                 encoder_backend="torch", onnx_dir="data/onnx",
+                 vector_backend="chroma", embedding_precision="float32", feedback_compact_every=1000,
+                 products_flush_every=100, products_flush_delay=2.0, lazy=False, shared=False,
+                 feedback_mode="sync", recommendation_cache_size=10000, recommendation_cache_ttl=300.0,
+                 recommendation_cache_depth=50, viewed_history_path=None, viewed_history_size=500, neighbour_k=20,
+                 metrics=None):
         # Ensure directories exist
         os.makedirs(os.path.dirname(products_path), exist_ok=True)
         os.makedirs(os.path.dirname(feedback_path), exist_ok=True)
@@ -20,146 +41,567 @@ class ProductRecommendationEngine:
         
         self.db_path = db_path
         self.products_path = products_path
+        self.products_writer = WriteBehindSnapshot(
+            products_path,
+            lambda: self.products.to_list(),
+            max_pending=products_flush_every,
+            max_delay=products_flush_delay
+        )
         self.feedback_path = feedback_path
+        self.feedback_store = FeedbackStore(feedback_path, compact_every=feedback_compact_every)
+        self.model_name = model_name
+        # "torch", or "onnx"/"onnx-int8" to run an export of the same model with
+        # onnxruntime (exported into onnx_dir on first use)
+        self.encoder_backend = encoder_backend
+        self.onnx_dir = onnx_dir
+        
+        # Shared mode: warmed up once in a pre-fork master and used by several
+        # worker processes. Workers pick up each other's feedback from the event
+        # log, whichever crosses the threshold compacts it, and preference
+        # vectors are kept in memory rather than written to Chroma from every
+        # worker. Each worker holds its own copy of the catalogue, so workers
+        # refuse catalogue edits (see catalogue_editable).
+        self.shared = shared
+        self.catalogue_path = os.path.splitext(products_path)[0] + '.f32'
+        # Rows of the last CSV read that could not be used, with the reason
+        self.csv_rejects_path = os.path.join(os.path.dirname(products_path), 'csv_rejects.csv')
+        
+        # Per-stage timings and counters for /metrics; a disabled registry
+        # (the default) makes every instrumentation call a no-op
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.metrics.add_collector(self._collect_metrics)
+        
+        # The embedding model and ChromaDB are opened on first use (or by
+        # warm_up), so constructing the engine with lazy=True is cheap
+        self._model = None
+        self._client = None
+        self._product_collection = None
+        self._user_collection = None
+        self._forked = False
+        self._init_lock = threading.RLock()
+        # BM25 index over product text, built on first search
+        self._text_index = None
+        
+        # Set once the model and vector index are loaded; until then
+        # recommendations are random picks from the catalogue
+        self.ready = threading.Event()
+        self.warmup_error = None
+        self._users_pending_refresh = set()
+        
+        # On-disk cache of model outputs; other backends' vectors differ
+        # slightly, so they get their own
+        cache_name = model_name if encoder_backend == "torch" else f"{model_name}@{encoder_backend}"
+        self.embedding_cache = EmbeddingCache(cache_dir, cache_name)
+        
+        # Every text-to-vector call shares the model through one micro-batching
+        # queue, with an LRU cache of recent texts (search queries in particular)
+        self.encoder = BatchingEncoder(self._run_model)
+        
+        # Per-user running sums behind each preference embedding
+        self.preference_state = {}
+        
+        # Each user's top-ranked candidates from their last vector search;
+        # page turns are served from it until feedback or a catalogue edit
+        # invalidates it (recommendation_cache_size=0 turns it off)
+        self.recommendation_cache = RecommendationCache(
+            max_users=recommendation_cache_size,
+            ttl=recommendation_cache_ttl,
+            depth=recommendation_cache_depth
+        )
+        
+        # Products each user has been shown, excluded from their later
+        # recommendations; a bounded ring per user kept on the server, logged
+        # to viewed_history_path when one is given
+        self.viewed_history = ViewedHistory(capacity=viewed_history_size, log_path=viewed_history_path)
         
-        # Initialize embedding model
-        self.model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        # The neighbour_k most similar products of every product, computed
+        # from the catalogue matrix after warm-up and saved next to it;
+        # similar-product lookups and single-like cold starts read them
+        # instead of running a vector query (neighbour_k=0 turns this off).
+        # Edits update the graph in memory and it is rewritten in batches,
+        # like the products file
+        self.neighbour_k = neighbour_k
+        self.neighbours_path = os.path.splitext(products_path)[0] + '-neighbours'
+        self.neighbours = None
+        self._neighbours_lock = threading.Lock()
+        self.neighbours_writer = WriteBehindSnapshot(
+            self.neighbours_path,
+            self._neighbours_snapshot,
+            max_pending=products_flush_every,
+            max_delay=products_flush_delay,
+            write_fn=self._write_neighbours
+        )
+        # Modification time of the saved graph when a worker last looked
+        self._neighbours_seen = None
+        
+        # Guards self.feedback and the running sums against the background
+        # feedback worker
+        self._feedback_lock = threading.RLock()
+        
+        # In "async" feedback mode clicks only touch memory; persistence and
+        # preference updates run on a worker thread, coalesced per user
+        if feedback_mode not in ("sync", "async"):
+            raise ValueError(f"Unknown feedback mode: {feedback_mode}")
+        self.feedback_mode = feedback_mode
+        self.feedback_stats = {'events_enqueued': 0, 'events_processed': 0, 'recomputes': 0}
+        self._feedback_queue = OrderedDict()
+        self._feedback_queue_cond = threading.Condition(self._feedback_lock)
+        if feedback_mode == "async":
+            self._start_feedback_worker()
+            atexit.register(self.drain_feedback_queue)
+        
+        # Load products data
+        self.load_products()
+        self.load_feedback()
+        self.load_viewed_history()
+        
+        # Nearest-neighbour search: Chroma's HNSW index or exact NumPy scoring,
+        # optionally over a float16/int8 copy of the catalogue with a float32 rerank
+        if shared and vector_backend != "numpy":
+            raise ValueError("Shared mode needs the numpy vector backend; ChromaDB is not fork-safe")
+        if vector_backend == "chroma":
+            self.vector_backend = ChromaBackend(lambda: self.product_collection)
+        elif vector_backend == "numpy":
+            self.vector_backend = NumpyBackend(self.products, precision=embedding_precision)
+        else:
+            raise ValueError(f"Unknown vector backend: {vector_backend}")
+        if embedding_precision != "float32" and vector_backend != "numpy":
+            raise ValueError("Compressed embeddings need the numpy vector backend")
         
-        # Initialize ChromaDB
-        self.client = chromadb.PersistentClient(
-            path=db_path,
+        if not lazy:
+            self.warm_up()
+    
+    @property
+    def model(self):
+        """Sentence embedding model, imported and loaded on first use"""
+        if self._model is None:
+            with self._init_lock:
+                if self._model is None:
+                    self._model = load_encoder(self.model_name, self.encoder_backend, self.onnx_dir)
+        return self._model
+    
+    @property
+    def text_index(self):
+        """Lexical index over product text, built on first use and then kept in step with the catalogue"""
+        if self._text_index is None:
+            with self._init_lock:
+                if self._text_index is None:
+                    index = BM25Index()
+                    for product in self.products:
+                        index.add(product['id'], self._get_product_text(product))
+                    self._text_index = index
+        return self._text_index
+    
+    @property
+    def client(self):
+        """ChromaDB client and collections, opened on first use"""
+        if self._client is None:
+            if self._forked:
+                raise RuntimeError("ChromaDB is not fork-safe and cannot be opened in a shared-mode worker")
+            with self._init_lock:
+                if self._client is None:
+                    self._open_vector_store()
+        return self._client
+    
+    @property
+    def product_collection(self):
+        self.client
+        return self._product_collection
+    
+    @property
+    def user_collection(self):
+        self.client
+        return self._user_collection
+    
+    def _open_vector_store(self):
+        """Initialize ChromaDB and its collections"""
+        import chromadb
+        from chromadb.config import Settings
+        
+        client = chromadb.PersistentClient(
+            path=self.db_path,
             settings=Settings(anonymized_telemetry=False)
         )
         
         # Initialize collections
         try:
-            self.product_collection = self.client.get_collection(name="products")
+            self._product_collection = client.get_collection(name="products")
         except Exception as e:
             print(f"Creating new products collection: {str(e)}")
-            self.product_collection = self.client.create_collection(
+            self._product_collection = client.create_collection(
                 name="products",
                 metadata={"hnsw:space": "cosine"}
             )
             
         try:
-            self.user_collection = self.client.get_collection(name="user_preferences")
+            self._user_collection = client.get_collection(name="user_preferences")
         except Exception as e:
             print(f"Creating new user_preferences collection: {str(e)}")
-            self.user_collection = self.client.create_collection(
+            self._user_collection = client.create_collection(
                 name="user_preferences",
                 metadata={"hnsw:space": "cosine"}
             )
         
-        # Load products data
-        self.load_products()
-        self.load_feedback()
+        self._client = client
+    
+    def _run_model(self, texts):
+        """Embed one batch of texts with the model"""
+        with self.metrics.span('encode'):
+            embeddings = self.model.encode(texts)
+        self.metrics.observe('encode_batch_size', len(texts), buckets=SIZE_BUCKETS)
+        return embeddings
+    
+    def _collect_metrics(self):
+        """Counters the engine keeps anyway, read when metrics are rendered"""
+        yield 'products', 'gauge', len(self.products), None
+        yield 'ready', 'gauge', int(self.ready.is_set()), None
+        yield 'preference_states', 'gauge', len(self.preference_state), None
+        yield 'viewed_history_users', 'gauge', len(self.viewed_history), None
+        yield 'neighbour_graph_current', 'gauge', int(self._current_neighbours() is not None), None
+        
+        queue = self.feedback_queue_stats()
+        yield 'feedback_queue_depth', 'gauge', queue['queue_depth'], None
+        yield 'feedback_events_processed_total', 'counter', queue['events_processed'], None
+        yield 'feedback_recomputes_total', 'counter', queue['recomputes'], None
+        
+        cache = self.recommendation_cache.stats()
+        yield 'recommendation_cache_entries', 'gauge', cache['size'], None
+        for outcome in ('hits', 'misses'):
+            yield 'recommendation_cache_lookups_total', 'counter', cache[outcome], {'outcome': outcome}
+        yield 'recommendation_cache_invalidations_total', 'counter', cache['invalidations'], None
+        
+        encoder = self.encoder.stats()
+        yield 'encoder_requests_total', 'counter', encoder['requests'], None
+        yield 'encoder_cache_hits_total', 'counter', encoder['cache_hits'], None
+        yield 'encoder_texts_encoded_total', 'counter', encoder['texts_encoded'], None
+        
+        # Bytes this process wrote to each of its persistence files
+        written = {
+            'feedback': self.feedback_store.bytes_written,
+            'products': self.products_writer.bytes_written,
+            'neighbour_graph': self.neighbours_writer.bytes_written,
+            'embedding_cache': self.embedding_cache.bytes_written,
+            'viewed_history': self.viewed_history.bytes_written
+        }
+        for target, size in written.items():
+            yield 'persistence_written_bytes_total', 'counter', size, {'target': target}
+    
+    def warm_up(self, csv_path=None, on_ready=None):
+        """Load the model and vector index, optionally sync the CSV, then mark the engine ready"""
+        start_time = time.perf_counter()
+        self.model
+        self.client
+        
+        if csv_path:
+            self.sync_products_from_csv(csv_path)
+        if on_ready is not None:
+            on_ready(self)
+        if self.vector_backend.uses_catalogue_matrix:
+            self._ensure_catalogue_embeddings()
+        
+        # Feedback that arrived before the index was ready only reached the
+        # event log; bring those users' stored vectors up to date
+        while self._users_pending_refresh:
+            self.update_user_preference(self._users_pending_refresh.pop())
+        
+        # Feedback checks ready under the same lock, so users queued after the
+        # loop above are handed over here rather than left in the set
+        with self._feedback_lock:
+            self.ready.set()
+            pending, self._users_pending_refresh = self._users_pending_refresh, set()
+        for user_id in pending:
+            self.update_user_preference(user_id)
+        print(f"Recommendation engine ready in {time.perf_counter() - start_time:.2f}s")
+        
+        # The graph build is quadratic in the catalogue size, so it runs on
+        # its own thread; until it is done similar-product lookups fall back
+        # to a vector query. A shared-mode master only maps a saved graph,
+        # as a thread would not survive the fork (see build_neighbours.py)
+        if self.neighbour_k:
+            if self.shared:
+                self.load_neighbours()
+            else:
+                self.start_neighbour_build()
+    
+    def start_background_warmup(self, csv_path=None, on_ready=None):
+        """Run warm_up on a daemon thread so the app can serve straight away"""
+        def run():
+            try:
+                self.warm_up(csv_path, on_ready)
+            except Exception as e:
+                self.warmup_error = str(e)
+                print(f"Error warming up recommendation engine: {str(e)}")
+        
+        thread = threading.Thread(target=run, name="engine-warmup", daemon=True)
+        thread.start()
+        return thread
+    
+    def start_neighbour_build(self):
+        """Run build_neighbours on a daemon thread"""
+        def run():
+            try:
+                self.build_neighbours()
+            except Exception as e:
+                print(f"Error building neighbour graph: {str(e)}")
+        
+        thread = threading.Thread(target=run, name="neighbour-build", daemon=True)
+        thread.start()
+        return thread
+    
+    def is_ready(self):
+        return self.ready.is_set()
     
-    def load_products_from_csv(self, csv_path):
-        """Load wine products from the LCBO CSV file"""
+    def share_catalogue(self):
+        """Move the catalogue embedding matrix into a memory-mapped file before forking workers"""
+        self._ensure_catalogue_embeddings()
+        self.products.map_embeddings(self.catalogue_path)
+        # Build any compressed copy now so the workers share it too; the
+        # float32 rows then stay on disk apart from reranked candidates
+        if getattr(self.vector_backend, 'precision', 'float32') != 'float32':
+            self.vector_backend.quantized()
+        # Likewise the text index, rather than once per worker on first search
+        self.text_index
+        print(f"Shared {len(self.products)} product embeddings via {self.catalogue_path}")
+    
+    def after_fork(self, threads=1):
+        """Reset per-process state in a worker forked from a warmed-up master"""
+        # Locks and timers do not survive a fork, and the master's SQLite
+        # handles must not be used from several processes
+        self._init_lock = threading.RLock()
+        self._neighbours_lock = threading.Lock()
+        self.neighbours_writer.after_fork()
+        self._client = None
+        self._product_collection = None
+        self._user_collection = None
+        self._forked = True
+        self.products_writer.after_fork()
+        self.encoder.after_fork()
+        
+        # The logs' locks are per process; their file handles are kept so the
+        # workers follow a compaction made after the master read them
+        self.feedback_store.after_fork()
+        self.viewed_history.after_fork()
+        
+        # The feedback worker thread did not survive the fork either
+        self._feedback_lock = threading.RLock()
+        self._feedback_queue_cond = threading.Condition(self._feedback_lock)
+        if self.feedback_mode == "async":
+            self._start_feedback_worker()
+        
+        # One intra-op thread per worker keeps N workers from oversubscribing
+        # the CPU; an onnxruntime session also needs reopening, as its thread
+        # pool stayed behind in the master
+        if 'torch' in sys.modules:
+            sys.modules['torch'].set_num_threads(threads)
+        if hasattr(self._model, 'after_fork'):
+            self._model.after_fork(threads)
+    
+    def _refresh_shared_feedback(self):
+        """Apply feedback and views other worker processes have appended to their logs"""
+        if not self.shared:
+            return
+        with self._feedback_lock:
+            events = self.feedback_store.read_new_events()
+            if events is None:
+                # Compacted more than once since the last read; the snapshot
+                # holds everything
+                self.feedback = self.feedback_store.load()
+                self.preference_state.clear()
+                self.recommendation_cache.clear()
+                events = ()
+            for event in events:
+                like_delta, dislike_delta = apply_feedback_event(self.feedback, event)
+                self.recommendation_cache.invalidate(event['user_id'])
+                if event['user_id'] in self.preference_state:
+                    self._apply_preference_delta(event['user_id'], event['product_id'], like_delta, dislike_delta)
+        
+        # A cached ranking was searched excluding the views a reset just cleared
+        for user_id in self.viewed_history.refresh():
+            self.recommendation_cache.invalidate(user_id)
+    
+    def clear_viewed_history(self, user_id):
+        """Forget the products a user has been shown, so they can be recommended again"""
+        self.viewed_history.clear(user_id)
+        # The cached ranking was searched with those products excluded
+        self.recommendation_cache.invalidate(user_id)
+    
+    def load_products_from_csv(self, csv_path, batch_size=64):
+        """Load wine products from the LCBO CSV file in embedding batches"""
         if not os.path.exists(csv_path):
             print(f"CSV file not found: {csv_path}")
             return 0
         
         products_added = 0
+        start_time = time.perf_counter()
         
         try:
-            with open(csv_path, 'r', encoding='utf-8') as csvfile:
-                csv_reader = csv.DictReader(csvfile)
-                for row in csv_reader:
-                    try:
-                        # Use permanent_id as the product ID
-                        product_id = str(row.get('permanent_id', uuid.uuid4()))
-                        
-                        # Format price properly
-                        try:
-                            price = float(row.get('price', 0.0))
-                        except (ValueError, TypeError):
-                            price = 0.0
-                        
-                        # Create product object mapping LCBO data to our structure
-                        product = {
-                            'id': product_id,
-                            'name': row.get('title', ''),
-                            'description': row.get('description', ''),
-                            'price': price,
-                            'category': row.get('subcategory', row.get('category', '')),
-                            'tags': f"{row.get('country', '')},{row.get('brand', '')},{row.get('alcohol_content', '')}",
-                            'image': row.get('image_url', ''),
-                            'rating': row.get('rating', '0'),
-                            'alcohol_content': row.get('alcohol_content', '0')
-                        }
-                        
-                        # Skip products with missing essential data
-                        if not product['name']:
-                            continue
-                        
-                        # Add to products list
-                        self.products.append(product)
-                        
-                        # Create product text for embedding
-                        product_text = self._get_product_text(product)
-                        product_embedding = self.model.encode(product_text)
-                        
-                        # Add metadata
-                        metadata = {
-                            'name': product['name'],
-                            'category': product['category'],
-                            'price': str(product['price']),
-                            'country': row.get('country', ''),
-                            'alcohol_content': row.get('alcohol_content', ''),
-                            'rating': row.get('rating', ''),
-                            'product_id': product_id
-                        }
-                        
-                        # Add to collection
-                        self.product_collection.add(
-                            ids=[product_id],
-                            documents=[product_text],
-                            metadatas=[metadata]
-                        )
-                        
-                        products_added += 1
-                        
-                    except Exception as e:
-                        print(f"Error processing row: {str(e)}")
-                        continue
-                
-                # Save products to JSON
-                self.save_products()
-                print(f"Added {products_added} wine products from CSV")
-                return products_added
-                
+            batch = []
+            for entry in self._read_csv_products(csv_path):
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    products_added += self._add_product_batch(batch)
+                    batch = []
+            
+            if batch:
+                products_added += self._add_product_batch(batch)
+            
+            # Save products to JSON
+            self.save_products()
+            
+            elapsed = time.perf_counter() - start_time
+            rate = products_added / elapsed if elapsed > 0 else 0.0
+            print(f"Added {products_added} wine products from CSV in {elapsed:.2f}s ({rate:.1f} rows/s)")
+            return products_added
+            
         except Exception as e:
             print(f"Error loading CSV: {str(e)}")
-            return 0
+            return products_added
+    
+    def sync_products_from_csv(self, csv_path, batch_size=64):
+        """Bring the persisted catalogue in line with the CSV, touching only changed rows"""
+        if not os.path.exists(csv_path):
+            print(f"CSV file not found: {csv_path}")
+            return None
+        
+        start_time = time.perf_counter()
+        entries = list(self._read_csv_products(csv_path))
+        csv_ids = {product['id'] for product, _ in entries}
+        
+        # Content hashes of what is already in the vector store
+        existing = self.product_collection.get(include=['metadatas'])
+        existing_hashes = {}
+        removed_ids = []
+        for product_id, metadata in zip(existing['ids'], existing['metadatas']):
+            metadata = metadata or {}
+            existing_hashes[product_id] = metadata.get('content_hash')
+            # Only rows that came from the CSV are ours to delete; admin-added
+            # products are left alone
+            if metadata.get('source') == 'csv' and product_id not in csv_ids:
+                removed_ids.append(product_id)
+        
+        changed = [(product, metadata) for product, metadata in entries
+                   if existing_hashes.get(product['id']) != metadata['content_hash']]
+        
+        for i in range(0, len(changed), batch_size):
+            self.product_collection.upsert(**self._product_batch_records(changed[i:i + batch_size]))
+        
+        if removed_ids:
+            self.product_collection.delete(ids=removed_ids)
+        
+        # CSV products in file order, followed by anything added through the admin
+        removed = set(removed_ids)
+        products = [product for product, _ in entries]
+        products.extend(p for p in self.products if p['id'] not in csv_ids and p['id'] not in removed)
+        if products != self.products.to_list():
+            self.products.reset(products)
+            self._text_index = None
+            self.save_products()
+        if changed or removed_ids:
+            self.preference_state.clear()
+            self.recommendation_cache.clear()
+        
+        stats = {
+            'added': sum(1 for product, _ in changed if product['id'] not in existing_hashes),
+            'updated': sum(1 for product, _ in changed if product['id'] in existing_hashes),
+            'deleted': len(removed_ids),
+            'unchanged': len(entries) - len(changed)
+        }
+        elapsed = time.perf_counter() - start_time
+        print(f"Synced catalogue from CSV in {elapsed:.2f}s: {stats}")
+        return stats
+    
+    def _read_csv_products(self, csv_path):
+        """Return (product, metadata) pairs for the usable, unique rows of a CSV file"""
+        start_time = time.perf_counter()
+        reader = CatalogueReader()
+        entries = reader.read(csv_path)
+        
+        # Rows that were skipped are listed with the reason, rather than
+        # printed one by one; the report always describes the last read
+        rejected = reader.write_rejects(self.csv_rejects_path)
+        if rejected:
+            print(f"Rejected {rejected} CSV rows, see {self.csv_rejects_path}")
+        elapsed = time.perf_counter() - start_time
+        print(f"Parsed {len(entries)} products from {csv_path} in {elapsed:.2f}s")
+        return entries
+    
+    def _product_batch_records(self, entries):
+        """Embed a batch of (product, metadata) pairs into Chroma add/upsert arguments"""
+        products = [product for product, _ in entries]
+        product_texts = [self._get_product_text(product) for product in products]
+        
+        # One batched encode call for cache misses; the vectors go straight into
+        # Chroma so it never has to run its own embedding function
+        embeddings = self._encode_texts(product_texts)
+        
+        return {
+            'ids': [product['id'] for product in products],
+            'embeddings': [embedding.tolist() for embedding in embeddings],
+            'documents': product_texts,
+            'metadatas': [metadata for _, metadata in entries]
+        }
+    
+    def _add_product_batch(self, entries):
+        """Embed a batch of (product, metadata) pairs once and bulk-add them to the vector store"""
+        records = self._product_batch_records(entries)
+        self.product_collection.add(**records)
+        for (product, _), embedding in zip(entries, records['embeddings']):
+            self.products.add(product, embedding)
+            if self._text_index is not None:
+                self._text_index.add(product['id'], self._get_product_text(product))
+        self.recommendation_cache.clear()
+        return len(entries)
 
     def load_products(self):
         """Load products from JSON file"""
         try:
             with open(self.products_path, 'r') as f:
-                self.products = json.load(f)
+                self.products = ProductStore(json.load(f))
         except (FileNotFoundError, json.JSONDecodeError):
-            self.products = []
+            self.products = ProductStore()
             self.save_products()
     
     def save_products(self):
-        """Save products to JSON file"""
-        with open(self.products_path, 'w') as f:
-            json.dump(self.products, f, indent=2)
+        """Save products to JSON file right away"""
+        self.products_writer.flush(force=True)
     
     def load_feedback(self):
-        """Load user feedback from JSON file"""
-        try:
-            with open(self.feedback_path, 'r') as f:
-                self.feedback = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            self.feedback = {"users": {}}
+        """Load user feedback from the JSON snapshot and replay the event log"""
+        self.feedback = self.feedback_store.load()
+        # In shared mode the master starts the workers off with an empty log
+        if (not os.path.exists(self.feedback_path) or self.feedback_store.needs_compaction()
+                or (self.shared and self.feedback_store.pending_events)):
             self.save_feedback()
     
+    def load_viewed_history(self):
+        """Replay the viewed-products log, compacting it if it has grown"""
+        self.viewed_history.load()
+        # At startup nothing is being served yet, so this compacts inline; in
+        # shared mode the master starts the workers off with a compact log
+        if self.viewed_history.needs_compaction() or (self.shared and self.viewed_history.pending_lines):
+            self.viewed_history.compact()
+    
     def save_feedback(self):
-        """Save user feedback to JSON file"""
-        with open(self.feedback_path, 'w') as f:
-            json.dump(self.feedback, f, indent=2)
+        """Compact user feedback into the JSON snapshot"""
+        with self.metrics.span('save_feedback'):
+            self.feedback_store.compact(self.feedback)
+    
+    def _encode_texts(self, texts):
+        """Embed texts through the on-disk cache, sending only misses to the encoder"""
+        return self.embedding_cache.encode(texts, self.encoder.encode)
+    
+    def _product_embeddings(self, product_ids):
+        """Return catalogue embeddings for product IDs, filling any gaps from the cache in one batch"""
+        missing = [product_id for product_id in product_ids if self.products.embedding(product_id) is None]
+        if missing:
+            products = [self.products.get(product_id) for product_id in missing]
+            embeddings = self._encode_texts([self._get_product_text(p) for p in products])
+            for product_id, embedding in zip(missing, embeddings):
+                self.products.set_embedding(product_id, embedding)
+        
+        if not product_ids:
+            return np.zeros((0, self.embedding_cache.dim or 0), dtype=np.float32)
+        return np.array([self.products.embedding(product_id) for product_id in product_ids])
     
     def _get_product_text(self, product):
         """Create a textual representation of a wine product for embedding"""
@@ -178,8 +620,20 @@ class ProductRecommendationEngine:
         
         return wine_text
 
+    @property
+    def catalogue_editable(self):
+        """False in shared-mode workers, whose catalogue copies would drift apart"""
+        return not self._forked
+    
+    def _check_catalogue_editable(self):
+        if not self.catalogue_editable:
+            # Every worker would also rewrite the products file from its own copy
+            raise RuntimeError("The catalogue cannot be edited from a shared-mode worker; "
+                               "edit it in single-process mode and restart the workers")
+    
     def add_product(self, product):
         """Add a product to the system"""
+        self._check_catalogue_editable()
         # Generate product ID if not provided
         if 'id' not in product:
             product['id'] = str(uuid.uuid4())
@@ -187,22 +641,38 @@ class ProductRecommendationEngine:
         # Add timestamp
         product['created_at'] = datetime.now().isoformat()
         
-        # Add to products list
-        self.products.append(product)
-        self.save_products()
-        
-        # Add to vector store
+        # Create product text and embedding
         product_text = self._get_product_text(product)
-        product_embedding = self.model.encode(product_text)
+        product_embedding = self._encode_texts([product_text])[0]
+        
+        # Add to products list; the JSON file is rewritten in batches
+        version = self.products.version
+        self.products.add(product, product_embedding)
+        self.products_writer.mark_dirty()
+        self._update_neighbours(version, lambda graph: graph.insert(self.products.row(product['id']),
+                                                                   self.products.embeddings))
+        if self._text_index is not None:
+            self._text_index.add(product['id'], product_text)
+        
+        # Running preference sums only cover products that existed when built,
+        # and the new product may outrank anything in a cached list
+        self.preference_state.clear()
+        self.recommendation_cache.clear()
+        
+        # Add to vector store (the master's ChromaDB cannot be used from a forked worker)
+        if self.shared:
+            return product
         
         self.product_collection.add(
             ids=[product['id']],
+            embeddings=[product_embedding.tolist()],
             documents=[product_text],
             metadatas=[{
                 'name': product['name'],
-                'category': product['category'],
-                'price': str(product['price']),
-                'product_id': product['id']
+                'product_id': product['id'],
+                # Price, category, country, alcohol content and rating, so
+                # filtered searches match added products as they do CSV ones
+                **filter_metadata(product)
             }]
         )
         
@@ -210,11 +680,23 @@ class ProductRecommendationEngine:
     
     def delete_product(self, product_id):
         """Delete a product from the system"""
-        # Remove from products list
-        self.products = [p for p in self.products if p['id'] != product_id]
-        self.save_products()
+        self._check_catalogue_editable()
+        # Remove from products list; the JSON file is rewritten in batches
+        version = self.products.version
+        row = self.products.row(product_id)
+        self.products.remove(product_id)
+        self.products_writer.mark_dirty()
+        if row is not None:
+            self._update_neighbours(version, lambda graph: graph.remove(row, self.products.embeddings))
+        if self._text_index is not None:
+            self._text_index.remove(product_id)
+        self.preference_state.clear()
+        # Cached lists stay valid: IDs no longer in the catalogue are skipped
+        # when a list is read
         
         # Remove from vector store
+        if self.shared:
+            return True
         try:
             self.product_collection.delete(ids=[product_id])
         except:
@@ -224,77 +706,184 @@ class ProductRecommendationEngine:
     
     def add_feedback(self, user_id, product_id, feedback_type):
         """Add user feedback for a product"""
-        # Initialize user if not exists
-        if user_id not in self.feedback["users"]:
-            self.feedback["users"][user_id] = {
-                "likes": [],
-                "dislikes": [],
-                "timestamps": {}
-            }
-        
-        # Remove product from opposite list if it exists
-        if feedback_type == "up":
-            if product_id in self.feedback["users"][user_id]["dislikes"]:
-                self.feedback["users"][user_id]["dislikes"].remove(product_id)
-            if product_id not in self.feedback["users"][user_id]["likes"]:
-                self.feedback["users"][user_id]["likes"].append(product_id)
-        else:  # feedback_type == "down"
-            if product_id in self.feedback["users"][user_id]["likes"]:
-                self.feedback["users"][user_id]["likes"].remove(product_id)
-            if product_id not in self.feedback["users"][user_id]["dislikes"]:
-                self.feedback["users"][user_id]["dislikes"].append(product_id)
+        self._refresh_shared_feedback()
         
-        # Add timestamp
-        self.feedback["users"][user_id]["timestamps"][product_id] = datetime.now().isoformat()
+        event = {
+            'user_id': user_id,
+            'product_id': product_id,
+            'feedback': feedback_type,
+            'timestamp': datetime.now().isoformat()
+        }
+        
+        with self._feedback_lock:
+            like_delta, dislike_delta = apply_feedback_event(self.feedback, event)
+            self.recommendation_cache.invalidate(user_id)
+            
+            # Async mode: hand the event to the feedback worker; recommendations
+            # keep using the current in-memory vector until it catches up
+            if self.feedback_mode == "async":
+                self._feedback_queue.setdefault(user_id, []).append((event, like_delta, dislike_delta))
+                self.feedback_stats['events_enqueued'] += 1
+                self._feedback_queue_cond.notify()
+                return True
+        
+        self._persist_feedback_events([event])
+        self._update_preference_after_feedback(user_id, [(event, like_delta, dislike_delta)])
+        return True
+    
+    def _persist_feedback_events(self, events):
+        """Append events to the log, folding it into the snapshot every so often"""
+        with self.metrics.span('persist_feedback'):
+            for event in events:
+                self.feedback_store.append(event)
+        if self.feedback_store.needs_compaction():
+            with self._feedback_lock, self.feedback_store.exclusive():
+                # The snapshot must include other workers' events too, and one
+                # of them may have compacted first
+                self._refresh_shared_feedback()
+                if self.feedback_store.needs_compaction():
+                    self.save_feedback()
+    
+    def _update_preference_after_feedback(self, user_id, items):
+        """Fold (event, like_delta, dislike_delta) items into a user's preference embedding"""
+        with self._feedback_lock:
+            if not self.ready.is_set():
+                self._users_pending_refresh.add(user_id)
+                return
+        
+        with self._feedback_lock, self.metrics.span('update_preference'):
+            # Update user preference embedding from the running sums, or build
+            # them from the full history the first time we see this user
+            if user_id in self.preference_state:
+                for event, like_delta, dislike_delta in items:
+                    self._apply_preference_delta(user_id, event['product_id'], like_delta, dislike_delta)
+            else:
+                self._rebuild_preference_state(user_id)
+            state = self.preference_state.get(user_id)
         
-        # Save feedback
-        self.save_feedback()
+        self._store_user_preference(user_id, state['embedding'] if state else None)
+        # Anything cached from the old vector (e.g. by a request served while
+        # the async worker was catching up) is now out of date
+        self.recommendation_cache.invalidate(user_id)
+    
+    def _start_feedback_worker(self):
+        thread = threading.Thread(target=self._feedback_worker, name="feedback-worker", daemon=True)
+        thread.start()
+        return thread
+    
+    def _feedback_worker(self):
+        """Persist queued feedback and recompute each waiting user's vector once"""
+        while True:
+            with self._feedback_queue_cond:
+                while not self._feedback_queue:
+                    self._feedback_queue_cond.wait()
+            # Disk and vector-store writes happen outside the lock, so clicks
+            # arriving meanwhile are only queued behind them
+            self._process_next_feedback_batch()
+    
+    def _process_next_feedback_batch(self):
+        """Take every queued event for the longest-waiting user and apply them together"""
+        with self._feedback_lock:
+            if not self._feedback_queue:
+                return False
+            user_id, items = self._feedback_queue.popitem(last=False)
         
-        # Update user preference embedding
-        self.update_user_preference(user_id)
+        self._persist_feedback_events([event for event, _, _ in items])
+        self._update_preference_after_feedback(user_id, items)
         
+        with self._feedback_lock:
+            self.feedback_stats['events_processed'] += len(items)
+            self.feedback_stats['recomputes'] += 1
         return True
     
+    def drain_feedback_queue(self):
+        """Process everything still queued on the calling thread, e.g. at shutdown"""
+        while self._process_next_feedback_batch():
+            pass
+    
+    def feedback_queue_stats(self):
+        """Queue depth and coalescing counters for the async feedback pipeline"""
+        with self._feedback_lock:
+            stats = dict(self.feedback_stats)
+            stats['mode'] = self.feedback_mode
+            stats['queue_depth'] = len(self._feedback_queue)
+            stats['queued_events'] = sum(len(items) for items in self._feedback_queue.values())
+        stats['coalesced'] = stats['events_processed'] - stats['recomputes']
+        return stats
+    
     def update_user_preference(self, user_id):
-        """Update user preference embedding based on feedback"""
+        """Rebuild a user's preference embedding from their full feedback history"""
         if user_id not in self.feedback["users"]:
             return None
         
-        user_data = self.feedback["users"][user_id]
-        liked_products = [p for p in self.products if p['id'] in user_data["likes"]]
-        disliked_products = [p for p in self.products if p['id'] in user_data["dislikes"]]
+        with self._feedback_lock:
+            state = self._rebuild_preference_state(user_id)
         
-        # If no feedback, return None
-        if not liked_products and not disliked_products:
-            return None
+        # If no feedback, None clears any stale stored vector
+        self._store_user_preference(user_id, state['embedding'])
+        return state['embedding']
+    
+    def _rebuild_preference_state(self, user_id):
+        """Recompute a user's running sums from their full like/dislike lists"""
+        user_data = self.feedback["users"].get(user_id, {"likes": [], "dislikes": []})
+        liked_ids = [product_id for product_id in user_data["likes"] if product_id in self.products]
+        disliked_ids = [product_id for product_id in user_data["dislikes"] if product_id in self.products]
         
-        # Get embeddings for liked and disliked products
-        liked_embeddings = []
-        for product in liked_products:
-            product_text = self._get_product_text(product)
-            liked_embeddings.append(self.model.encode(product_text))
+        # Get embeddings for liked and disliked products from the catalogue matrix
+        liked_embeddings = self._product_embeddings(liked_ids)
+        disliked_embeddings = self._product_embeddings(disliked_ids)
         
-        disliked_embeddings = []
-        for product in disliked_products:
-            product_text = self._get_product_text(product)
-            disliked_embeddings.append(self.model.encode(product_text))
+        # Keep running sums so later feedback only costs a vector add/subtract
+        state = {
+            'liked_sum': liked_embeddings.sum(axis=0, dtype=np.float64) if len(liked_embeddings) else 0.0,
+            'liked_count': len(liked_embeddings),
+            'disliked_sum': disliked_embeddings.sum(axis=0, dtype=np.float64) if len(disliked_embeddings) else 0.0,
+            'disliked_count': len(disliked_embeddings)
+        }
+        state['embedding'] = self._preference_from_state(state)
+        self.preference_state[user_id] = state
         
-        # Compute preference embedding
-        if liked_embeddings:
-            liked_avg = np.mean(liked_embeddings, axis=0)
-        else:
-            liked_avg = np.zeros(self.model.get_sentence_embedding_dimension())
-            
-        if disliked_embeddings:
-            disliked_avg = np.mean(disliked_embeddings, axis=0)
-        else:
-            disliked_avg = np.zeros(self.model.get_sentence_embedding_dimension())
+        # Queued events for this user are already in the lists just read
+        if user_id in self._feedback_queue:
+            self._feedback_queue[user_id] = [(event, 0, 0) for event, _, _ in self._feedback_queue[user_id]]
+        return state
+    
+    def _apply_preference_delta(self, user_id, product_id, like_delta, dislike_delta):
+        """Add or remove one product's embedding from a user's running sums"""
+        if not like_delta and not dislike_delta:
+            return
+        
+        if product_id not in self.products:
+            # Feedback on products outside the catalogue never counted
+            return
+        
+        state = self.preference_state.get(user_id)
+        if state is None:
+            return
+        
+        embedding = self._product_embeddings([product_id])[0].astype(np.float64)
+        if like_delta:
+            state['liked_sum'] = state['liked_sum'] + like_delta * embedding
+            state['liked_count'] += like_delta
+        if dislike_delta:
+            state['disliked_sum'] = state['disliked_sum'] + dislike_delta * embedding
+            state['disliked_count'] += dislike_delta
+        state['embedding'] = self._preference_from_state(state)
+    
+    def _preference_from_state(self, state):
+        """Compute the preference embedding from running like/dislike sums"""
+        # If no feedback, there is no preference
+        if not state['liked_count'] and not state['disliked_count']:
+            return None
+        
+        liked_avg = state['liked_sum'] / state['liked_count'] if state['liked_count'] else 0.0
         
         # Compute preference embedding: move toward liked, away from disliked
         preference_embedding = liked_avg
-        if disliked_embeddings:
+        if state['disliked_count']:
             # Subtract disliked, but ensure we don't go too far
             scale_factor = 0.5
+            disliked_avg = state['disliked_sum'] / state['disliked_count']
             preference_embedding = preference_embedding - (disliked_avg * scale_factor)
             
             # Normalize the embedding
@@ -302,73 +891,421 @@ class ProductRecommendationEngine:
             if norm > 0:
                 preference_embedding = preference_embedding / norm
         
-        # Update or add to vector store
-        try:
-            self.user_collection.get(ids=[user_id])
-            self.user_collection.update(
-                ids=[user_id],
-                embeddings=[preference_embedding.tolist()],
-                metadatas=[{'user_id': user_id}]
-            )
-        except:
-            self.user_collection.add(
+        return np.asarray(preference_embedding, dtype=np.float32)
+    
+    def _store_user_preference(self, user_id, preference_embedding):
+        """Write a user's preference embedding to the vector store"""
+        if self.shared:
+            # Rebuilt from the feedback log in each worker instead
+            return
+        
+        with self.metrics.span('store_user_preference'):
+            if preference_embedding is None:
+                try:
+                    self.user_collection.delete(ids=[user_id])
+                except Exception:
+                    pass  # User may not be in vector store
+                return
+            
+            self.user_collection.upsert(
                 ids=[user_id],
                 embeddings=[preference_embedding.tolist()],
                 metadatas=[{'user_id': user_id}]
             )
+    
+    def get_recommendations(self, user_id, n_results=3, excluded_ids=None, filters=None, record_views=False):
+        """Get product recommendations for a user.
         
-        return preference_embedding
+        Products in the user's viewed history are never recommended, nor are
+        excluded_ids; record_views=True adds this page to the history.
+        filters is an optional Chroma-style where clause over price, country,
+        category, alcohol_content and rating, e.g.
+        {'$and': [{'price': {'$lte': 20}}, {'category': 'Red Wine'}]}
+        """
+        return self.get_recommendations_batch([user_id], n_results, {user_id: excluded_ids}, filters,
+                                              record_views)[user_id]
     
-    def get_recommendations(self, user_id, n_results=3, excluded_ids=None):
-        """Get product recommendations for a user"""
-        if excluded_ids is None:
-            excluded_ids = []
+    def get_recommendations_batch(self, user_ids, n_results=3, excluded_ids_per_user=None, filters=None,
+                                  record_views=False):
+        """Get product recommendations for many users with a single vector search"""
+        if filters:
+            validate_where(filters)
+        user_ids = list(dict.fromkeys(user_ids))
+        excluded_ids_per_user = excluded_ids_per_user or {}
         
-        # Try to get user's preference embedding
-        try:
-            results = self.user_collection.get(ids=[user_id])
-            preference_embedding = results['embeddings'][0]
-        except:
-            # If no profile exists, try to create one
-            preference_embedding = self.update_user_preference(user_id)
-            
-            # If still no embedding, return random products
-            if preference_embedding is None:
-                # Get random products excluding already seen ones
-                available_products = [p for p in self.products if p['id'] not in excluded_ids]
-                if len(available_products) <= n_results:
-                    return available_products
-                else:
-                    import random
-                    return random.sample(available_products, n_results)
-        
-        # Query for products using the preference embedding
-        results = self.product_collection.query(
-            query_embeddings=[preference_embedding.tolist()],
-            n_results=n_results + len(excluded_ids)  # Query more to account for excluded IDs
-        )
+        self._refresh_shared_feedback()
+        excluded = {
+            user_id: self.viewed_history.ids(user_id).union(excluded_ids_per_user.get(user_id) or [])
+            for user_id in user_ids
+        }
+        
+        # Read before the preference vectors, so a ranking computed from a
+        # vector that changes meanwhile is not cached
+        cache_epoch = self.recommendation_cache.epoch
+        
+        # Until the vector index is ready everyone gets random picks
+        seeded = {}
+        if self.ready.is_set():
+            self._refresh_shared_neighbours()
+            # A user whose only feedback is one like has that product's
+            # embedding as their preference, so the like and its precomputed
+            # neighbours are the ranking a vector search would return
+            if not filters:
+                for user_id in user_ids:
+                    ranking = self._single_like_ranking(user_id)
+                    if ranking is not None and self._ranking_covers(ranking, n_results, excluded[user_id],
+                                                                    self.neighbour_k + 1):
+                        seeded[user_id] = ranking
+                self.metrics.inc('neighbour_rankings_total', len(seeded))
+            preference_embeddings = self._load_preference_embeddings(
+                [user_id for user_id in user_ids if user_id not in seeded]
+            )
+        else:
+            preference_embeddings = {}
+        
+        # Query for products using all preference embeddings at once, with
+        # exclusions pushed into the search so its size never grows with a session
+        ranked_users = [user_id for user_id in user_ids if user_id in preference_embeddings]
+        ranked_ids = dict(seeded)
+        
+        # Page turns are served from the cached ranking while it still holds
+        # enough unseen products; it only holds unfiltered rankings
+        cache = self.recommendation_cache
+        use_cache = cache.enabled and not filters
+        misses = []
+        for user_id in ranked_users:
+            cached = cache.get(user_id) if use_cache else None
+            if cached is not None and self._ranking_covers(cached, n_results, excluded[user_id]):
+                ranked_ids[user_id] = cached
+                cache.record(hit=True)
+            else:
+                misses.append(user_id)
+                if use_cache:
+                    cache.record(hit=False)
         
-        # Filter out excluded IDs and get product details
-        recommended_products = []
-        for i, product_id in enumerate(results['ids'][0]):
-            if product_id not in excluded_ids:
-                # Find the full product details
-                product = next((p for p in self.products if p['id'] == product_id), None)
-                if product:
-                    recommended_products.append(product)
+        if misses:
+            # Fetch a deeper list than this page needs so the next ones are free
+            depth = max(n_results, cache.depth) if use_cache else n_results
+            results = self._search(
+                [preference_embeddings[user_id] for user_id in misses],
+                depth,
+                [excluded[user_id] for user_id in misses],
+                filters
+            )
+            for user_id, ids in zip(misses, results):
+                ranked_ids[user_id] = ids
+                if use_cache:
+                    cache.put(user_id, ids, cache_epoch)
+                # Candidates fetched per product on the page
+                self.metrics.observe('recommendation_overfetch_ratio', len(ids) / max(n_results, 1),
+                                     buckets=RATIO_BUCKETS)
+        
+        # Random top-ups respect the filters too
+        filtered_rows = None
+        
+        recommendations = {}
+        with self.metrics.span('assemble_recommendations'):
+            for user_id in user_ids:
+                # Filter out excluded IDs and get product details
+                recommended_products = []
+                for product_id in ranked_ids.get(user_id, []):
+                    product = self.products.get(product_id)
+                    if product and product_id not in excluded[user_id]:
+                        recommended_products.append(product)
+                    if len(recommended_products) >= n_results:
+                        break
                 
-                if len(recommended_products) >= n_results:
-                    break
+                # Users without a preference embedding, or without enough matches,
+                # get random products excluding already seen ones
+                ranked_count = len(recommended_products)
+                if len(recommended_products) < n_results:
+                    seen_ids = excluded[user_id] | {p['id'] for p in recommended_products}
+                    if filters and filtered_rows is None:
+                        filtered_rows = self.products.filter_rows(filters)
+                    recommended_products.extend(
+                        self.products.sample(n_results - len(recommended_products), seen_ids, filtered_rows)
+                    )
+                random_count = len(recommended_products) - ranked_count
+                self.metrics.inc('recommended_products_total', ranked_count, source='ranked')
+                self.metrics.inc('recommended_products_total', random_count, source='random')
+                
+                recommendations[user_id] = recommended_products
+                if record_views:
+                    self.viewed_history.add(user_id, [p['id'] for p in recommended_products])
+        
+        return recommendations
+    
+    def search_products(self, query, n_results=10, mode="auto", user_id=None, excluded_ids=None, filters=None):
+        """Free-text product search over the BM25 index, the vector index, or both.
         
-        # If we didn't get enough recommendations, add some random products
-        if len(recommended_products) < n_results:
-            seen_ids = set([p['id'] for p in recommended_products] + excluded_ids)
-            available_products = [p for p in self.products if p['id'] not in seen_ids]
+        "lexical" ranks by BM25 alone and "vector" by similarity to the
+        embedded query. "hybrid" fuses the two rankings, plus the user's
+        preference ranking when user_id is given, by reciprocal rank fusion.
+        "auto" answers from the text index alone, without running the model,
+        when a few products contain every query term (a producer or wine
+        name), and runs hybrid otherwise.
+        """
+        if mode not in ("auto", "lexical", "vector", "hybrid"):
+            raise ValueError(f"Unknown search mode: {mode}")
+        if filters:
+            validate_where(filters)
+        excluded = set(excluded_ids or [])
+        allowed = None
+        if filters:
+            allowed = {self.products[row]['id'] for row in self.products.filter_rows(filters)}
+        
+        if mode == "auto":
+            exact_matches = self.text_index.matching_all(query) - excluded
+            if allowed is not None:
+                exact_matches &= allowed
+            if exact_matches and len(exact_matches) <= n_results:
+                mode = "lexical"
+            else:
+                mode = "hybrid"
+        
+        # The vector side needs the model; until warm-up finishes it is text only
+        if mode == "lexical" or not self.ready.is_set():
+            hits = self.text_index.search(query, n_results, excluded, allowed)
+            return [self.products.get(product_id) for product_id, _ in hits]
+        
+        # Each ranking goes deeper than the page so fusion has overlap to work with
+        depth = n_results if mode == "vector" else max(n_results * 5, 50)
+        rankings = []
+        if mode == "hybrid":
+            rankings.append([product_id for product_id, _ in self.text_index.search(query, depth, excluded, allowed)])
+        
+        query_embeddings = [self.encoder.encode([query])[0]]
+        if mode == "hybrid" and user_id is not None:
+            preference = self._load_preference_embeddings([user_id]).get(user_id)
+            if preference is not None:
+                query_embeddings.append(preference)
+        rankings.extend(self._search(query_embeddings, depth, [excluded] * len(query_embeddings), filters))
+        
+        ranked_ids = reciprocal_rank_fusion(rankings) if len(rankings) > 1 else rankings[0]
+        products = (self.products.get(product_id) for product_id in ranked_ids)
+        return [product for product in products if product][:n_results]
+    
+    def _ranking_covers(self, ranked_ids, n_results, excluded_ids, depth=None):
+        """Whether a ranking (cached, by default) can fill a page without a new search"""
+        # A list shorter than its full depth already held every candidate
+        if len(ranked_ids) < (depth or self.recommendation_cache.depth):
+            return True
+        available = 0
+        for product_id in ranked_ids:
+            if product_id not in excluded_ids and product_id in self.products:
+                available += 1
+                if available >= n_results:
+                    return True
+        return False
+    
+    def build_neighbours(self):
+        """Load the neighbour graph saved for this catalogue, or compute and save a new one"""
+        self._ensure_catalogue_embeddings()
+        while True:
+            version = self.products.version
+            start_time = time.perf_counter()
+            fingerprint = catalogue_fingerprint(self.products.ids(), self.products.embeddings)
+            graph = NeighbourGraph.load(self.neighbours_path, fingerprint, self.neighbour_k)
+            if graph is None:
+                with self.metrics.span('build_neighbours'):
+                    graph = NeighbourGraph.build(self.products.embeddings, self.neighbour_k)
+                if not self._forked:
+                    graph.save(self.neighbours_path, fingerprint)
+                    # Mapped from the file, so forked workers share the pages
+                    graph = NeighbourGraph.load(self.neighbours_path, fingerprint, self.neighbour_k) or graph
+                elapsed = time.perf_counter() - start_time
+                print(f"Built {self.neighbour_k} neighbours for each of {len(graph)} products in {elapsed:.2f}s")
             
-            import random
-            additional_needed = min(n_results - len(recommended_products), len(available_products))
-            if additional_needed > 0:
-                additional_products = random.sample(available_products, additional_needed)
-                recommended_products.extend(additional_products)
+            if self._install_neighbours(graph, version):
+                return graph
+            # The catalogue changed while the graph was built; start over
+    
+    def load_neighbours(self):
+        """Use the neighbour graph saved for this catalogue, if there is one; returns it or None"""
+        version = self.products.version
+        fingerprint = catalogue_fingerprint(self.products.ids(), self.products.embeddings)
+        graph = NeighbourGraph.load(self.neighbours_path, fingerprint, self.neighbour_k)
+        if graph is None or not self._install_neighbours(graph, version):
+            return None
+        return graph
+    
+    def _install_neighbours(self, graph, version):
+        """Make graph the current one, unless the catalogue has moved on from version"""
+        with self._neighbours_lock:
+            if self.products.version != version:
+                return False
+            graph.version = version
+            self.neighbours = graph
+            return True
+    
+    def _refresh_shared_neighbours(self):
+        """In a shared-mode worker without a graph, map one saved since it last looked"""
+        if not self._forked or not self.neighbour_k or self._current_neighbours() is not None:
+            return
+        try:
+            saved = os.stat(f"{self.neighbours_path}.json").st_mtime_ns
+        except FileNotFoundError:
+            return
+        # Hashing the catalogue is only worth it for a file it has not seen
+        if saved != self._neighbours_seen:
+            self._neighbours_seen = saved
+            self.load_neighbours()
+    
+    def _current_neighbours(self):
+        """The neighbour graph, or None if it is missing or the catalogue has changed under it"""
+        graph = self.neighbours
+        if graph is None or graph.version != self.products.version:
+            return None
+        return graph
+    
+    def _update_neighbours(self, version, update):
+        """Apply a single-product edit to the neighbour graph, if it matched the catalogue before the edit"""
+        with self._neighbours_lock:
+            graph = self.neighbours
+            if graph is None or graph.version != version:
+                # Edits to an out-of-date graph are left to the next build
+                return
+            with self.metrics.span('update_neighbours'):
+                update(graph)
+            graph.version = self.products.version
+        # Saved in batches; a flush takes the graph lock itself
+        self.neighbours_writer.mark_dirty()
+    
+    def _neighbours_snapshot(self):
+        """A copy of the current graph and the fingerprint of its catalogue, or None if it is out of date"""
+        with self._neighbours_lock:
+            graph = self._current_neighbours()
+            if graph is None:
+                return None
+            graph = graph.copy()
+        ids = self.products.ids()
+        fingerprint = catalogue_fingerprint(ids, self.products.embeddings)
+        # An edit that landed while hashing marks the graph dirty again
+        if len(ids) != len(graph) or self.products.version != graph.version:
+            return None
+        return graph, fingerprint
+    
+    @staticmethod
+    def _write_neighbours(path, snapshot):
+        if snapshot is None:
+            return 0
+        graph, fingerprint = snapshot
+        return graph.save(path, fingerprint)
+    
+    def _neighbour_ids(self, product_id):
+        """A product's precomputed neighbours, best first, or None if the graph is out of date"""
+        with self._neighbours_lock:
+            graph = self._current_neighbours()
+            row = self.products.row(product_id)
+            if graph is None or row is None:
+                return None
+            rows, _ = graph.neighbours(row)
+            return [self.products[neighbour]['id'] for neighbour in rows]
+    
+    def _single_like_ranking(self, user_id):
+        """The liked product and its neighbours, for a user whose only feedback is one like"""
+        if self._current_neighbours() is None:
+            return None
+        # The running sums answer this without scanning the history
+        state = self.preference_state.get(user_id)
+        if state is not None and (state['liked_count'] != 1 or state['disliked_count']):
+            return None
+        
+        user_data = self.feedback["users"].get(user_id)
+        if user_data is None:
+            return None
+        liked_ids = [product_id for product_id in user_data["likes"] if product_id in self.products]
+        if len(liked_ids) != 1 or any(product_id in self.products for product_id in user_data["dislikes"]):
+            return None
+        
+        neighbours = self._neighbour_ids(liked_ids[0])
+        return None if neighbours is None else [liked_ids[0]] + neighbours
+    
+    def get_similar_products(self, product_id, n_results=5, excluded_ids=None):
+        """Products most similar to the given one, or None if it is not in the catalogue.
+        
+        Served from the precomputed neighbour lists; while they are being
+        built, or after a bulk catalogue change, a vector query stands in.
+        """
+        if product_id not in self.products:
+            return None
+        excluded = set(excluded_ids or []) | {product_id}
         
-        return recommended_products
\ No newline at end of file
+        self._refresh_shared_neighbours()
+        ranked_ids = self._neighbour_ids(product_id)
+        if ranked_ids is not None and self._ranking_covers(ranked_ids, n_results, excluded, self.neighbour_k):
+            self.metrics.inc('similar_products_total', source='neighbours')
+        elif self.ready.is_set():
+            self.metrics.inc('similar_products_total', source='vector_search')
+            embedding = self._product_embeddings([product_id])[0]
+            ranked_ids = self._search([embedding], n_results, [excluded])[0]
+        else:
+            return []
+        
+        products = (self.products.get(similar_id) for similar_id in ranked_ids if similar_id not in excluded)
+        return [product for product in products if product][:n_results]
+    
+    def _load_preference_embeddings(self, user_ids):
+        """Return {user_id: preference embedding} for the users that have one"""
+        embeddings = {}
+        missing = []
+        
+        # Try in-memory preference embeddings first
+        for user_id in user_ids:
+            if user_id in self.preference_state:
+                if self.preference_state[user_id]['embedding'] is not None:
+                    embeddings[user_id] = self.preference_state[user_id]['embedding']
+            else:
+                missing.append(user_id)
+        
+        # Async mode keeps the vector store off the request thread: the
+        # vectors are rebuilt from the feedback in memory, which the stored
+        # ones were computed from, and the feedback worker writes them on
+        # the user's next click
+        if missing and self.feedback_mode == "async":
+            with self._feedback_lock:
+                for user_id in missing:
+                    if user_id in self.feedback["users"]:
+                        embedding = self._rebuild_preference_state(user_id)['embedding']
+                        if embedding is not None:
+                            embeddings[user_id] = embedding
+            return embeddings
+        
+        # Then the stored vectors, fetched in one call
+        if missing and not self.shared:
+            try:
+                with self.metrics.span('load_user_preferences'):
+                    results = self.user_collection.get(ids=missing, include=['embeddings'])
+                for user_id, embedding in zip(results['ids'], results['embeddings']):
+                    embeddings[user_id] = np.asarray(embedding, dtype=np.float32)
+            except Exception as e:
+                print(f"Error loading user preferences: {str(e)}")
+        
+        # If no profile exists, try to create one
+        for user_id in missing:
+            if user_id not in embeddings:
+                preference_embedding = self.update_user_preference(user_id)
+                if preference_embedding is not None:
+                    embeddings[user_id] = preference_embedding
+        
+        return embeddings
+    
+    def _search(self, query_embeddings, n_results, excluded_ids, filters=None):
+        """Run a nearest-neighbour search on the configured vector backend"""
+        if self.vector_backend.uses_catalogue_matrix:
+            self._ensure_catalogue_embeddings()
+        
+        # IDs no longer in the catalogue cannot be returned anyway
+        excluded_ids = [{product_id for product_id in excluded if product_id in self.products}
+                        for excluded in excluded_ids]
+        self.metrics.inc('vector_queries_total', len(query_embeddings), backend=self.vector_backend.name)
+        with self.metrics.span('vector_search', backend=self.vector_backend.name):
+            return self.vector_backend.search(query_embeddings, n_results, excluded_ids, filters)
+    
+    def _ensure_catalogue_embeddings(self, chunk_size=10000):
+        """Fill in embedding rows for any products loaded without one"""
+        missing = [p['id'] for p in self.products.missing_embeddings()]
+        # In chunks, so a large catalogue's texts and vectors are never all
+        # held in memory next to the matrix they are copied into
+        for start in range(0, len(missing), chunk_size):
+            self._product_embeddings(missing[start:start + chunk_size])
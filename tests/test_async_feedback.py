@@ -0,0 +1,35 @@
+import benchmark
+
+
+class RecordingCollection:
+    """Stands in for the ChromaDB client and user collection, recording every call"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            raise AssertionError(f"vector store {name}() called on the request thread")
+        return call
+
+
+def test_async_recommendations_rebuild_preferences_without_the_vector_store(tmp_path):
+    csv_path = str(tmp_path / 'catalogue.csv')
+    product_ids = benchmark.synthetic_catalogue_csv(csv_path, 50)
+    users = benchmark.synthetic_feedback(str(tmp_path / 'feedback.json'), product_ids, 3)
+    engine = benchmark.scratch_engine(str(tmp_path), str(tmp_path / 'cache'), feedback_mode='async')
+    engine._model = benchmark.HashingEncoder(384)
+    engine.products.reset(product for product, _ in engine._read_csv_products(csv_path))
+    engine._ensure_catalogue_embeddings()
+    store = RecordingCollection()
+    engine._client, engine._user_collection = store, store
+    engine.ready.set()
+
+    # First request after a restart: the feedback is loaded, the vector is not
+    products = engine.get_recommendations(users[0], n_results=3)
+
+    assert store.calls == []
+    assert len(products) == 3
+    state = engine.preference_state[users[0]]
+    assert state['liked_count'] == len(engine.feedback['users'][users[0]]['likes'])
@@ -0,0 +1,50 @@
+import pytest
+
+import csv_ingest
+from csv_ingest import CatalogueReader
+
+HEADER = 'permanent_id,title,price,subcategory,country\n'
+
+
+def _read(tmp_path, monkeypatch, rows, pyarrow):
+    if pyarrow:
+        pytest.importorskip('pyarrow')
+    monkeypatch.setattr(csv_ingest, '_pyarrow_available', lambda: pyarrow)
+    path = tmp_path / 'catalogue.csv'
+    path.write_text(HEADER + ''.join(rows), encoding='utf-8')
+    reader = CatalogueReader(chunksize=2)
+    products = [product for product, _ in reader.read(str(path))]
+    return products, reader.rejects
+
+
+@pytest.mark.parametrize('pyarrow', [False, True], ids=['c', 'pyarrow'])
+def test_overlong_first_row_is_rejected_with_its_line(tmp_path, monkeypatch, pyarrow):
+    products, rejects = _read(tmp_path, monkeypatch, [
+        '1,Shiraz,10.00,Red Wine,Australia,stray\n',
+        '2,Merlot,12.50,Red Wine,Chile\n',
+        '3,Riesling,9.00,White Wine,Germany\n',
+    ], pyarrow)
+
+    assert [(p['id'], p['name'], p['price'], p['category']) for p in products] == [
+        ('2', 'Merlot', 12.5, 'Red Wine'),
+        ('3', 'Riesling', 9.0, 'White Wine'),
+    ]
+    assert [(r['line'], r['reason']) for r in rejects] == [(2, 'malformed row: expected 5 fields, saw 6')]
+
+
+@pytest.mark.parametrize('pyarrow', [False, True], ids=['c', 'pyarrow'])
+def test_malformed_rows_keep_their_lines(tmp_path, monkeypatch, pyarrow):
+    products, rejects = _read(tmp_path, monkeypatch, [
+        '1,Shiraz,10.00,Red Wine,Australia\n',
+        '2,Merlot,12.50,Red Wine,Chile,stray\n',
+        '3,Riesling,9.00,White Wine,Germany,stray,stray\n',
+        '4,,9.00,White Wine,Germany\n',
+        '5,Malbec,15.00,Red Wine,Argentina\n',
+    ], pyarrow)
+
+    assert [p['id'] for p in products] == ['1', '5']
+    assert [(r['line'], r['reason']) for r in rejects] == [
+        (3, 'malformed row: expected 5 fields, saw 6'),
+        (4, 'malformed row: expected 5 fields, saw 7'),
+        (5, 'missing title'),
+    ]
@@ -0,0 +1,58 @@
+import multiprocessing
+
+from feedback_store import FeedbackStore
+
+
+def _event(user_id, product_id, feedback='up'):
+    return {'user_id': user_id, 'product_id': product_id, 'feedback': feedback, 'timestamp': '2025-01-01T00:00:00'}
+
+
+def _log_from_other_process(snapshot_path):
+    other = FeedbackStore(snapshot_path)
+    other.load()
+    other.append(_event('bob', 'p2'))
+    other.close()
+
+
+def _read_in_forked_worker(store, results):
+    store.after_fork()
+    results.put((store.read_new_events(), store.pending_events))
+
+
+def test_read_new_events_skips_this_process_own_events(tmp_path):
+    snapshot_path = str(tmp_path / 'feedback.json')
+    store = FeedbackStore(snapshot_path)
+    store.load()
+    store.append(_event('alice', 'p1'))
+    assert store.read_new_events() == []
+    assert store.pending_events == 1
+
+    fork = multiprocessing.get_context('fork')
+    worker = fork.Process(target=_log_from_other_process, args=(snapshot_path,))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+    events = store.read_new_events()
+    assert [(event['user_id'], event['product_id']) for event in events] == [('bob', 'p2')]
+    assert store.pending_events == 2
+
+    # A worker forked after the master logged an event already has it applied
+    store.append(_event('alice', 'p3'))
+    results = fork.Queue()
+    worker = fork.Process(target=_read_in_forked_worker, args=(store, results))
+    worker.start()
+    assert results.get(timeout=10) == ([], 3)
+    worker.join()
+
+
+def test_load_replays_every_process_events(tmp_path):
+    snapshot_path = str(tmp_path / 'feedback.json')
+    store = FeedbackStore(snapshot_path)
+    store.load()
+    store.append(_event('alice', 'p1'))
+    store.append(_event('alice', 'p1', 'down'))
+
+    feedback = FeedbackStore(snapshot_path).load()
+    assert feedback['users']['alice']['likes'] == []
+    assert feedback['users']['alice']['dislikes'] == ['p1']
@@ -0,0 +1,36 @@
+import multiprocessing
+
+from viewed_history import ViewedHistory
+
+
+def _reset_and_compact_twice(log_path):
+    other = ViewedHistory(log_path=log_path, compact_every=None)
+    other.load()
+    other.clear('alice')
+    other.compact()
+    other.add('bob', ['p9'])
+    other.compact()
+    other.close()
+
+
+def test_refresh_after_two_compactions_drops_users_reset_elsewhere(tmp_path):
+    log_path = str(tmp_path / 'viewed.jsonl')
+    history = ViewedHistory(log_path=log_path, compact_every=None)
+    history.load()
+    history.add('alice', ['p1', 'p2'])
+    history.add('bob', ['p3'])
+
+    # Lines are told apart by PID, so the other worker has to be a process
+    worker = multiprocessing.get_context('fork').Process(target=_reset_and_compact_twice, args=(log_path,))
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0
+
+    assert history.refresh() == {'alice'}
+    assert history.ids('alice') == set()
+    assert history.ids('bob') == {'p3', 'p9'}
+
+    fresh = ViewedHistory(log_path=log_path)
+    fresh.load()
+    assert fresh.ids('alice') == set()
+    assert fresh.ids('bob') == {'p3', 'p9'}
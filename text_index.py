@@ -0,0 +1,110 @@
+# text_index.py
+import re
+import math
+import heapq
+import threading
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse several ranked ID lists into one, scoring each ID by sum(1 / (k + rank))"""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class BM25Index:
+    """In-memory inverted index with Okapi BM25 ranking.
+
+    Postings map each term to {doc_id: term frequency}, so adding or removing
+    a document only touches its own terms. A query only visits the postings
+    of its terms, which for a producer name is a handful of documents.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lengths = {}
+        self.doc_terms = {}
+        self.total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_lengths
+
+    def add(self, doc_id, text):
+        """Index a document, replacing any earlier version of it"""
+        counts = {}
+        for term in tokenize(text):
+            counts[term] = counts.get(term, 0) + 1
+
+        with self._lock:
+            self.remove(doc_id)
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[doc_id] = count
+            self.doc_terms[doc_id] = list(counts)
+            self.doc_lengths[doc_id] = sum(counts.values())
+            self.total_length += self.doc_lengths[doc_id]
+
+    def remove(self, doc_id):
+        with self._lock:
+            if doc_id not in self.doc_lengths:
+                return False
+            for term in self.doc_terms.pop(doc_id):
+                postings = self.postings[term]
+                del postings[doc_id]
+                if not postings:
+                    del self.postings[term]
+            self.total_length -= self.doc_lengths.pop(doc_id)
+            return True
+
+    def document_frequency(self, term):
+        return len(self.postings.get(term, ()))
+
+    def matching_all(self, query):
+        """IDs of the documents containing every query term"""
+        terms = set(tokenize(query))
+        if not terms:
+            return set()
+        with self._lock:
+            postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+            matched = set(postings[0])
+            for posting in postings[1:]:
+                matched.intersection_update(posting)
+        return matched
+
+    def search(self, query, n_results=10, excluded_ids=None, allowed_ids=None):
+        """Return up to n_results (doc_id, score) pairs, best first"""
+        excluded_ids = excluded_ids or ()
+        terms = set(tokenize(query))
+
+        scores = {}
+        with self._lock:
+            if not self.doc_lengths:
+                return []
+            n_docs = len(self.doc_lengths)
+            avg_length = self.total_length / n_docs
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for doc_id, tf in postings.items():
+                    if doc_id in excluded_ids or (allowed_ids is not None and doc_id not in allowed_ids):
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        return heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,233 @@
+# vector_backends.py
+import numpy as np
+
+from product_filters import chroma_where
+from quantization import PRECISIONS, QuantizedMatrix
+
+
+class ChromaBackend:
+    """Nearest-neighbour search through the persisted Chroma products collection"""
+
+    name = 'chroma'
+    uses_catalogue_matrix = False
+
+    def __init__(self, get_collection):
+        # A callable, so the collection can be opened lazily
+        self.get_collection = get_collection
+
+    def search(self, query_embeddings, n_results, excluded_ids=None, where=None):
+        """Return one ranked list of product IDs per query vector.
+
+        excluded_ids holds one set of IDs per query (or None); they are pushed
+        into the query as a where filter so the search stays n_results wide.
+        where is an optional metadata filter applied to every query.
+        """
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        if excluded_ids is None:
+            excluded_ids = [set()] * len(query_embeddings)
+
+        # Queries sharing an exclusion set go to Chroma as one multi-query
+        groups = {}
+        for i, excluded in enumerate(excluded_ids):
+            groups.setdefault(frozenset(excluded or ()), []).append(i)
+
+        ranked = [None] * len(query_embeddings)
+        for excluded, positions in groups.items():
+            clauses = [chroma_where(where)] if where else []
+            if excluded:
+                clauses.append({'product_id': {'$nin': sorted(excluded)}})
+            results = self.get_collection().query(
+                query_embeddings=query_embeddings[positions].tolist(),
+                n_results=n_results,
+                where=clauses[0] if len(clauses) == 1 else ({'$and': clauses} if clauses else None),
+                include=[]
+            )
+            for position, ids in zip(positions, results['ids']):
+                ranked[position] = list(ids)
+        return ranked
+
+
+class NumpyBackend:
+    """Exact in-process search over the ProductStore embedding matrix.
+
+    Scores are normalized dot products computed as one matrix product per
+    batch of queries; top-k selection uses argpartition so only the k best
+    rows are ever sorted.
+
+    With precision 'float16' or 'int8' the scan runs over a compressed copy
+    of the catalogue, and the best rerank_factor * n_results candidates are
+    re-scored against the float32 rows before the final cut. Only those rows
+    of the full matrix are read, so it can stay memory-mapped on disk.
+
+    A where filter is evaluated on the store's typed columns first, and only
+    the matching rows are scored.
+    """
+
+    name = 'numpy'
+    uses_catalogue_matrix = True
+
+    def __init__(self, store, precision='float32', rerank_factor=4):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown embedding precision: {precision}")
+        self.store = store
+        self.precision = precision
+        self.rerank_factor = rerank_factor
+        self._inv_norms = None
+        self._inv_norms_version = None
+        self._quantized = None
+        self._quantized_version = None
+
+    def _inverse_norms(self):
+        """Per-row 1/||v||, patched row by row as the store changes"""
+        version = self.store.version
+        if self._inv_norms_version != version:
+            embeddings = self.store.embeddings
+            changes = self.store.changes_since(self._inv_norms_version)
+            if changes is None:
+                self._inv_norms = _inverse_norms(embeddings)
+            else:
+                inv_norms = self._inv_norms
+                rows, dirty = _replay_changes(changes, len(inv_norms),
+                                              lambda target, source: inv_norms.__setitem__(target, inv_norms[source]))
+                if rows > len(inv_norms):
+                    inv_norms = np.concatenate([inv_norms, np.zeros(rows - len(inv_norms), dtype=inv_norms.dtype)])
+                inv_norms = inv_norms[:rows]
+                inv_norms[dirty] = _inverse_norms(embeddings[dirty])
+                self._inv_norms = inv_norms
+            self._inv_norms_version = version
+        return self._inv_norms
+
+    def quantized(self):
+        """Compressed catalogue matrix, patched row by row as the store changes"""
+        version = self.store.version
+        if self._quantized_version != version:
+            embeddings = self.store.embeddings
+            changes = self.store.changes_since(self._quantized_version)
+            quantized = self._quantized
+            if changes is None or quantized.codes.shape[1:] != embeddings.shape[1:]:
+                self._quantized = QuantizedMatrix.from_embeddings(embeddings, self.precision)
+            else:
+                rows, dirty = _replay_changes(changes, len(quantized),
+                                              lambda target, source: quantized.move_row(source, target))
+                quantized.resize(rows)
+                if len(dirty):
+                    quantized.set_rows(dirty, embeddings[dirty])
+            self._quantized_version = version
+        return self._quantized
+
+    def scores(self, query_embeddings, rows=None):
+        """Cosine similarity of every query against every catalogue row (or just rows)"""
+        queries = _unit_rows(query_embeddings)
+        if self.precision != 'float32':
+            return self.quantized().scores(queries, rows)
+        if rows is None:
+            return (queries @ self.store.embeddings.T) * self._inverse_norms()
+        return (queries @ self.store.embeddings[rows].T) * self._inverse_norms()[rows]
+
+    def exact_scores(self, query_embeddings, rows):
+        """Full-precision cosine similarity of each query against its own candidate rows"""
+        queries = _unit_rows(query_embeddings)
+        candidates = self.store.embeddings[rows]
+        norms = np.linalg.norm(candidates, axis=2)
+        dots = np.einsum('qkd,qd->qk', candidates, queries)
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+    def search(self, query_embeddings, n_results, excluded_ids=None, where=None):
+        """Return one ranked list of product IDs per query vector"""
+        # Prune to the rows matching the filter before any scoring
+        rows = self.store.filter_rows(where) if where else None
+        if not len(self.store) or (rows is not None and not len(rows)):
+            return [[] for _ in np.atleast_2d(query_embeddings)]
+
+        # Score columns are catalogue rows, or positions in rows when filtered
+        scores = self.scores(query_embeddings, rows)
+        if excluded_ids is not None:
+            for i, excluded in enumerate(excluded_ids):
+                columns = [self.store.row(product_id) for product_id in excluded or ()]
+                columns = np.array([row for row in columns if row is not None], dtype=np.intp)
+                if rows is not None and len(columns):
+                    positions = np.minimum(np.searchsorted(rows, columns), len(rows) - 1)
+                    columns = positions[rows[positions] == columns]
+                if len(columns):
+                    scores[i, columns] = -np.inf
+
+        if self.precision != 'float32' and self.rerank_factor:
+            ranked_rows, ranked_scores = self._top_rows(scores, n_results * self.rerank_factor)
+            if rows is not None:
+                ranked_rows = rows[ranked_rows]
+            if ranked_rows.size:
+                # Re-score the shortlist exactly; masked rows stay masked
+                exact = self.exact_scores(query_embeddings, ranked_rows)
+                exact[ranked_scores == -np.inf] = -np.inf
+                order = np.argsort(-exact, axis=1, kind='stable')
+                ranked_rows = np.take_along_axis(ranked_rows, order, axis=1)
+                ranked_scores = np.take_along_axis(exact, order, axis=1)
+            return self._row_ids(ranked_rows[:, :n_results], ranked_scores[:, :n_results])
+
+        ranked_rows, ranked_scores = self._top_rows(scores, n_results)
+        if rows is not None:
+            ranked_rows = rows[ranked_rows]
+        return self._row_ids(ranked_rows, ranked_scores)
+
+    def _top_rows(self, scores, n_results):
+        """Row numbers and scores of the n_results best rows per query, best first"""
+        n_rows = scores.shape[1]
+        k = min(n_results, n_rows)
+        if k <= 0:
+            empty = np.zeros((len(scores), 0))
+            return empty.astype(np.intp), empty
+
+        if k < n_rows:
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(n_rows), scores.shape)
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+        ranked_rows = np.take_along_axis(candidates, order, axis=1)
+        ranked_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        return ranked_rows, ranked_scores
+
+    def _row_ids(self, ranked_rows, ranked_scores):
+        # Masked rows score -inf and are dropped when fewer than k remain
+        return [
+            [self.store[row]['id'] for row, score in zip(rows, row_scores) if score != -np.inf]
+            for rows, row_scores in zip(ranked_rows, ranked_scores)
+        ]
+
+
+def _inverse_norms(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1)
+    return np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+
+
+def _replay_changes(changes, rows, move):
+    """Follow ProductStore.changes_since() over an array derived from its rows.
+
+    move(target, source) copies a derived value into the slot of a deleted
+    row, as the store did. Returns the row count after the changes and the
+    rows whose derived values must be recomputed from their embeddings.
+    """
+    dirty = set()
+    for change in changes:
+        if change[0] == 'remove':
+            _, row, last = change
+            if row != last:
+                if last in dirty:
+                    dirty.add(row)
+                else:
+                    move(row, last)
+                    dirty.discard(row)
+            dirty.discard(last)
+            rows = last
+        else:
+            # A row was appended or its embedding replaced
+            row = change[1]
+            rows = max(rows, row + 1)
+            dirty.add(row)
+    return rows, np.array(sorted(dirty), dtype=np.intp)
+
+
+def _unit_rows(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
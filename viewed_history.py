@@ -0,0 +1,263 @@
+# viewed_history.py
+import os
+import json
+import time
+import threading
+import contextlib
+
+from array import array
+from collections import OrderedDict
+
+from append_log import AppendLog
+
+
+class ViewedHistory:
+    """Server-side record of the products each user has already been shown.
+
+    Every user gets a ring buffer of at most `capacity` int32 ordinals, which
+    index an append-only table of interned product IDs (catalogue rows move
+    when products are deleted, so they cannot serve as ordinals). Memory per
+    user and the cost of reading a history are therefore bounded however
+    long someone browses; once a ring is full the oldest views drop out and
+    those products may be shown again. Beyond max_users, the users seen
+    least recently are forgotten first.
+
+    With a log_path, views are also appended to an AppendLog that load()
+    replays. As with FeedbackStore, several processes may append to the same
+    log and pick up each other's views with refresh(). Once compact_every
+    lines have piled up, and at least as many as there are users, a
+    background thread rewrites the log as one line per user (see
+    compact()); any of the processes may do so.
+    """
+
+    def __init__(self, capacity=500, max_users=100000, log_path=None, compact_every=10000):
+        self.capacity = capacity
+        self.max_users = max_users
+        self.log_path = log_path
+        self.log = AppendLog(log_path) if log_path else None
+        self.compact_every = compact_every
+        # Log lines written since the last compaction
+        self.pending_lines = 0
+        self.bytes_written = 0
+
+        # user_id -> [ring of ordinals, index of the oldest entry once full,
+        # generation]; a ring from an earlier generation may be in use by a
+        # compaction and is copied before it is changed
+        self._users = OrderedDict()
+        self._generation = 0
+        self._ordinals = {}
+        self._product_ids = []
+        # Users whose history another process reset, for refresh() to report
+        self._reset_users = set()
+        self._compaction = None
+        self._lock = threading.Lock()
+        # Serializes reads of the log without holding up ids()
+        self._read_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._users)
+
+    def ids(self, user_id):
+        """The set of product IDs a user has been shown, oldest views excepted"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return set()
+            product_ids = self._product_ids
+            return {product_ids[ordinal] for ordinal in entry[0]}
+
+    def add(self, user_id, product_ids):
+        """Record that a user was shown these products"""
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        # Memory and log change together, so neither a compaction nor a
+        # replay of the log can fall between the two
+        with self._log_locked(), self._lock:
+            self._add(user_id, product_ids)
+            self._append({'user_id': user_id, 'viewed': product_ids})
+        if self.needs_compaction():
+            self._start_compaction()
+
+    def clear(self, user_id):
+        """Forget everything a user has been shown"""
+        with self._log_locked(), self._lock:
+            self._users.pop(user_id, None)
+            self._append({'user_id': user_id, 'history': []})
+
+    def _add(self, user_id, product_ids):
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = [array('i'), 0, self._generation]
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+            if entry[2] != self._generation:
+                entry[0] = array('i', entry[0])
+                entry[2] = self._generation
+
+        ring = entry[0]
+        for product_id in product_ids:
+            ordinal = self._ordinals.get(product_id)
+            if ordinal is None:
+                ordinal = self._ordinals[product_id] = len(self._product_ids)
+                self._product_ids.append(product_id)
+            if len(ring) < self.capacity:
+                ring.append(ordinal)
+            else:
+                # Full: overwrite the oldest view
+                ring[entry[1]] = ordinal
+                entry[1] = (entry[1] + 1) % self.capacity
+
+    def _apply(self, record):
+        user_id = record['user_id']
+        if 'history' in record:
+            # A compacted (or reset) history replaces whatever came before
+            self._users.pop(user_id, None)
+            if record['history']:
+                self._add(user_id, record['history'])
+        else:
+            self._add(user_id, record['viewed'])
+
+    def load(self):
+        """Replay the log into memory; returns the number of users remembered"""
+        with self._lock:
+            self._users.clear()
+            self.pending_lines = 0
+        if self.log is not None:
+            with self._read_lock:
+                self.log.reset()
+        # Lines from an earlier process that happened to have our PID count too
+        self._read(skip_own=False)
+        with self._lock:
+            self._reset_users.clear()
+        return len(self._users)
+
+    def refresh(self):
+        """Apply complete lines other processes have appended since the last read.
+
+        Returns the users whose history one of those lines reset.
+        """
+        self._read(skip_own=True)
+        with self._lock:
+            reset, self._reset_users = self._reset_users, set()
+        return reset
+
+    def _read(self, skip_own):
+        if self.log is None:
+            return
+        with self._read_lock:
+            replacements = self.log.replacements
+            records = self.log.read_new()
+            if records is None:
+                # Compacted more than once since we last looked, so start
+                # over as load() does; no view may be recorded between
+                # reading the log and applying it. Users reset elsewhere
+                # are simply missing from the compacted lines
+                with self._lock:
+                    previous = set(self._users)
+                    self._users.clear()
+                    self.log.reset()
+                    self.pending_lines = 0
+                    self._apply_records(self.log.read_new())
+                    self._reset_users.update(previous.difference(self._users))
+                return
+
+            if skip_own:
+                # Lines this process wrote were applied when it wrote them
+                pid = os.getpid()
+                records = [record for record in records if not (isinstance(record, dict) and record.get('pid') == pid)]
+            with self._lock:
+                if self.log.replacements != replacements:
+                    # Another process compacted
+                    self.pending_lines = 0
+                self._apply_records(records)
+
+    def _apply_records(self, records):
+        for record in records:
+            try:
+                self._apply(record)
+            except (KeyError, TypeError, AttributeError):
+                continue
+            if record.get('history') == []:
+                self._reset_users.add(record['user_id'])
+            self.pending_lines += 1
+
+    def _log_locked(self):
+        return self.log.locked() if self.log is not None else contextlib.nullcontext()
+
+    def _append(self, record):
+        """Log a record; the caller holds both locks"""
+        if self.log is None:
+            return
+        # The PID lets refresh() skip lines this process has already applied
+        record['pid'] = os.getpid()
+        self.bytes_written += self.log.append(record)
+        self.pending_lines += 1
+
+    def needs_compaction(self):
+        # A compaction writes a line per user, so waiting for as many new
+        # lines keeps the rewriting proportional to what was appended
+        return (self.log is not None and self.compact_every is not None
+                and self.pending_lines >= max(self.compact_every, len(self._users)))
+
+    def _start_compaction(self):
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+            self._compaction = threading.Thread(target=self.compact, name='viewed-history-compaction', daemon=True)
+            self._compaction.start()
+
+    def compact(self):
+        """Rewrite the log as one line per remembered user; returns the bytes written.
+
+        Other threads and processes only wait while the rings are listed;
+        rings changed after that are copied first (see _add). Serializing
+        happens outside every lock, and lines appended in the meantime are
+        carried over into the new log.
+        """
+        if self.log is None:
+            return 0
+        # Catch up first, so only what is appended meanwhile is read under the lock
+        self._read(skip_own=True)
+        with self.log.locked(exclusive=True):
+            self._read(skip_own=True)
+            with self._read_lock:
+                mark = self.log.mark()
+            with self._lock:
+                rings = [(user_id, entry[0], entry[1]) for user_id, entry in self._users.items()]
+                self._generation += 1
+                self.pending_lines = 0
+
+        # Ordinals are only ever appended, so the table can be read unlocked
+        product_ids = self._product_ids
+        chunks = []
+        for start in range(0, len(rings), 1000):
+            chunks.extend(
+                json.dumps({'user_id': user_id, 'history': [product_ids[ordinal] for ordinal in ring[oldest:] + ring[:oldest]]},
+                           separators=(',', ':')) + '\n'
+                for user_id, ring, oldest in rings[start:start + 1000]
+            )
+            # Let request threads waiting for the GIL in
+            time.sleep(0)
+        payload = ''.join(chunks).encode('utf-8')
+
+        written = self.log.replace(payload, mark)
+        if written is None:
+            # Another process compacted first
+            return 0
+        self.bytes_written += written
+        return written
+
+    def after_fork(self):
+        """Replace the locks inherited from the parent process; its log handles stay usable"""
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._compaction = None
+        if self.log is not None:
+            self.log.after_fork()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
@@ -0,0 +1,71 @@
+# write_behind.py
+import os
+import json
+import atexit
+import threading
+
+
+class WriteBehindSnapshot:
+    """Buffers mutations and writes a JSON snapshot in batches.
+
+    A flush happens once max_pending mutations have piled up, or max_delay
+    seconds after the first unflushed one, whichever comes first; a crash can
+    therefore lose at most max_delay seconds of edits. Each flush writes a
+    compact temp file and renames it over the snapshot, so readers never see
+    a half-written file. A write_fn(path, snapshot) returning the bytes
+    written stores snapshots that are not JSON.
+    """
+
+    def __init__(self, path, snapshot_fn, max_pending=100, max_delay=2.0, write_fn=None):
+        self.path = path
+        self.snapshot_fn = snapshot_fn
+        self.write_fn = write_fn or self._write_json
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+
+        self.pending = 0
+        self.bytes_written = 0
+        self._timer = None
+        self._lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def after_fork(self):
+        """Replace the lock and timer inherited from the parent process"""
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def mark_dirty(self, count=1):
+        """Record mutations, flushing now if the batch is full"""
+        with self._lock:
+            self.pending += count
+            if self.pending < self.max_pending and self.max_delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+
+        self.flush()
+
+    def flush(self, force=False):
+        """Write the snapshot if anything is pending (or always, with force)"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending and not force:
+                return 0
+
+            written = self.write_fn(self.path, self.snapshot_fn())
+            self.pending = 0
+            self.bytes_written += written
+            return written
+
+    @staticmethod
+    def _write_json(path, snapshot):
+        payload = json.dumps(snapshot, separators=(',', ':')).encode('utf-8')
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+        return len(payload)